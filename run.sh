@@ -1,10 +1,10 @@
 #!/usr/bin/env bash
 
 usage() {
-	echo "Usage: $(basename $0) -g glider_name -d mission_directory -m metadata_file_name -p mode(realtime|delayed) [-t CGDACusername]"
+	echo "Usage: $(basename $0) -g glider_name -d mission_directory -m metadata_file_name -p mode(realtime|delayed) [-t CGDACusername] [-w]"
 }
 
-while getopts ":g:d:m:p:t::" opt; do
+while getopts ":g:d:m:p:t::w" opt; do
 	case "${opt}" in
 	g)
 		glider=${OPTARG}
@@ -26,6 +26,10 @@ while getopts ":g:d:m:p:t::" opt; do
 		CGDAC_username=${OPTARG}
 		;;
 
+	w)
+		watch='--watch'
+		;;
+
 	h)
 		usage
 		exit 0
@@ -82,16 +86,14 @@ done
 
 cd ${missionDir}/${processingMode}/raw
 
-##  CHECK IF THERE IS ANY NC FILE OLDER THAN A TXT FILE
-newestRAWfile=$(ls -tr ${missionDir}/${processingMode}/raw | tail -1 | xargs -I{} date -r {} +%s)
-newestNCfile=$(ls -tr ${missionDir}/${processingMode}/nc | tail -1 | xargs -I{} date -r {} +%s)
-
-if [[ ${newestRAWfile} -gt ${newestNCfile} ]]; then
-	python3 ${scriptsDir}/bd2nc.py --glider=${glider} --mode=${processingMode} --metadataFile=${metadataFile}
-	# python3 ${scriptsDir}/bd2nc_oldMissions.py --glider=${glider} --mode=${processingMode} --metadataFile=${metadataFile}
-else
-	echo "No new file to process.  Exiting now."
-fi
+##  PROCESS NEW OR CHANGED RAW FILES
+##  (bd2nc.py keeps a manifest of the raw file fingerprints in ${missionDir}/${processingMode}/manifest.json
+##  and only reprocesses the segments that changed; it exits early if there is nothing new)
+##  (in realtime mode new segments are appended to the existing trajectory file instead of rebuilding it)
+##  (with -w bd2nc.py keeps running and processes the realtime segments as they arrive, until it is stopped)
+if [[ ${processingMode} == 'realtime' ]]; then appendTrajectory='--append'; fi
+python3 ${scriptsDir}/bd2nc.py --glider=${glider} --mode=${processingMode} --metadataFile=${metadataFile} ${appendTrajectory} ${watch}
+# python3 ${scriptsDir}/bd2nc_oldMissions.py --glider=${glider} --mode=${processingMode} --metadataFile=${metadataFile}
 find ${missionDir}/${processingMode}/nc -empty -delete
 
 ##  UPLOAD NC FILES TO CGDAC
@@ -1,28 +1,43 @@
 import warnings
 import argparse
+import traceback
+import fnmatch
+import signal
+import time
 import os.path
 import os
 import csv
 import glob
 import numpy as np
 import pandas as pd
-import math
 import multiprocessing
 import sys
+import json
+import hashlib
 import dbdreader
 from datetime import datetime
 
 
 scriptsDir = os.path.dirname(os.path.realpath(__file__))
 missionDir = os.path.abspath('../..')
+sensorCacheDir = '../../cache'
+# raw files the segments are listed by, and how long the service waits for the other half of a segment (s)
+RAW_PATTERN = '*.[dDtT][bBcC][dD]'
+PAIR_WAIT = 600
 sys.path.insert(0, scriptsDir)
 
-from quartod_qc import quartodQCchecks
-from data2attr import saveNetcdf
-from gliderfuncs import p2depth, deriveCTD, deriveO2, findProfiles, correctDeadReckoning, ignoreBadLatLon
+from quartod_qc import quartodQCbatch
+from data2attr import saveNetcdf, refreshAttributes, readAttributes
+from bdcache import segmentKey, readCachedBD, writeCachedBD, loadMeta, fileFingerprint
+from manifest import loadManifest, saveManifest, segmentInputs, isSegmentCurrent, saveResult, loadResult, attributeInputs
+from gliderfuncs import p2depth, deriveCTDO2, findProfiles, profileMeans
+from trajectory import buildTrajectory, appendTrajectory, streamTrajectory
+from shmframe import startTracker, publishFrames, attachFrames
+from ncupdate import reqcFiles
+from dtypepolicy import compactFrame, singleWhereExact, dtypePolicyFile
+from scheduler import schedulerSettings, runScheduled, availableCores, MEMORY_PER_RAW_BYTE
 
 # remove empty arrays and nanmean slice warnings
-warnings.simplefilter(action="ignore", category=pd.errors.PerformanceWarning)
 warnings.simplefilter("ignore", category=RuntimeWarning)
 
 
@@ -34,52 +49,163 @@ def printF(*args, **kwargs):
     return
 
 
-def readBDdata(filename, varFilter, ignore=False):
+def readBDdata(filename, varFilter, ignore=False, segmentDir='../segments'):
     """
     Reads *.?bd data from a given file and filters the columns based on the provided filter.
 
+    The filter is resolved against the parameter names in the file header before
+    decoding, so only the requested sensors are read by dbdreader.  The data frame is
+    built directly from the returned float arrays, in single precision wherever that
+    loses nothing (most sensors are 4-byte floats).  Decoded files are kept in the
+    segment cache and served from there as long as the raw file, the filter and the
+    sensor cache files are unchanged.
+
     :param filename: str, path to the file containing .bd data
     :param varFilter: list, a list of column names to filter the data
     :param ignore: bool, if True, the variables in the filter will be ignored, else they will be used
+    :param segmentDir: str, directory of the decoded segment cache (None disables the cache)
     :return: pd.DataFrame, filtered data
     """
     try:
-        bd = dbdreader.DBD(filename, cacheDir='../../cache')
-        dict = {}
-        params = bd.parameterNames
+        if segmentDir is not None:
+            key = segmentKey(filename, varFilter, ignore, sensorCacheDir)
+            cached = readCachedBD(filename, key, segmentDir)
+            if cached is not None:
+                return cached
+        bd = dbdreader.DBD(filename, cacheDir=sensorCacheDir)
+        params = selectParameters(bd.parameterNames, varFilter, ignore)
         allValues = bd.get_list(*params, return_nans=True)
-        for iParam in range(len(params)):
-            dict[params[iParam]] = allValues[iParam][1].tolist()
-        data = pd.DataFrame.from_dict(dict)
-        if varFilter is not None:
-            if ignore:
-                data = data.drop(columns=varFilter, errors='ignore')
-            else:
-                data = data.filter(varFilter, axis='columns')
+        data = pd.DataFrame({param: values[1] for param, values in zip(params, allValues)}, copy=False)
         ncFilename = bd.headerInfo['full_filename']
-        return data.rename(columns={bd.timeVariable: 'time'}), ncFilename
+        bd.close()
+        data = singleWhereExact(data.rename(columns={bd.timeVariable: 'time'}))
+        if segmentDir is not None:
+            writeCachedBD(filename, key, segmentDir, data, ncFilename)
+        return data, ncFilename
     except Exception as e:
         return pd.DataFrame(), ''  # Return an empty DataFrame in case of error
 
 
+def selectParameters(parameterNames, varFilter, ignore=False):
+    """
+    Resolves a variable filter against the parameters available in a *.?bd file.
+
+    :param parameterNames: list, parameter names from the file header
+    :param varFilter: list, a list of column names to filter the data (None keeps all)
+    :param ignore: bool, if True, the variables in the filter will be ignored, else they will be used
+    :return: list, the parameters to decode (in filter order when selecting)
+    """
+    if varFilter is None:
+        return list(parameterNames)
+    if ignore:
+        ignored = set(varFilter)
+        return [param for param in parameterNames if param not in ignored]
+    available = set(parameterNames)
+    return list(dict.fromkeys(param for param in varFilter if param in available))
+
+
+def segmentFiles(bdFilename, processingMode):
+    """
+    Returns the flight and science files of a segment, e.g. (X.DBD, X.EBD) in delayed
+    mode or (X.sbd, X.tbd) in realtime mode.
+
+    :param bdFilename: str, the raw file the segment is listed by (*.dbd in delayed mode, *.tbd in realtime mode)
+    :param processingMode: str, 'delayed' or 'realtime'
+    :return: tuple, (flight filename, science filename)
+    """
+    filename, ext = os.path.splitext(bdFilename)
+    if processingMode == 'delayed':
+        return bdFilename, '%s%s' % (filename, ext.replace('d', 'e', 1).replace('D', 'E', 1))
+    return '%s%s' % (filename, ext.replace('t', 's', 1).replace('T', 'S', 1)), bdFilename
+
+
 def readVarFilter(filterName):
     with open("%s/bin/%s" % (scriptsDir, filterName), 'r') as fid:
         return [row[0] for row in csv.reader(fid, delimiter=',')]
 
 
+def mergeRecords(flightData, scienceData, tolerance=None):
+    """
+    Merges the flight and science records of a segment into one record ordered by time.
+
+    Both records come time ordered from dbdreader, so the rows are merged in one pass: the
+    position of every row in the merged record is its own row number plus the number of rows
+    of the other record before it (np.searchsorted).  Each column is written once into its
+    rows of the merged grid, in the sorted union column order, without concatenating and
+    sorting the frames.  Rows with bad times (missing or outside 1e9-2e9) are dropped.
+
+    :param flightData: pd.DataFrame, flight record (*.dbd or *.sbd) with a 'time' column
+    :param scienceData: pd.DataFrame, science record (*.ebd or *.tbd) with a 'time' column
+    :param tolerance: float, science samples within this many seconds of a flight sample share its row
+        (the closest one; the row keeps the flight time).  None keeps every sample on its own row.
+    :return: pd.DataFrame, merged record
+    """
+    records = []
+    for df in [flightData, scienceData]:
+        if 'time' not in df:
+            records.append((df.iloc[:0], np.empty(0, dtype=int)))
+            continue
+        time = df['time'].to_numpy(dtype=float)
+        rows = np.flatnonzero((time >= 1000000000) & (time <= 2000000000))  # T Remove bad times
+        if np.any(np.diff(time[rows]) < 0):
+            rows = rows[np.argsort(time[rows], kind='stable')]
+        records.append((df, rows))
+    (flight, flightRows), (science, scienceRows) = records
+    flightTime = flight['time'].to_numpy(dtype=float)[flightRows] if len(flightRows) else np.empty(0)
+    scienceTime = science['time'].to_numpy(dtype=float)[scienceRows] if len(scienceRows) else np.empty(0)
+    #
+    # Science samples sharing the row of the closest flight sample (at most one per flight sample)
+    shared = np.zeros(len(scienceTime), dtype=bool)
+    partner = np.zeros(len(scienceTime), dtype=int)
+    if tolerance is not None and len(flightTime) and len(scienceTime):
+        after = np.clip(np.searchsorted(flightTime, scienceTime), 1, len(flightTime) - 1) if len(flightTime) > 1 else np.zeros(len(scienceTime), dtype=int)
+        before = np.maximum(after - 1, 0)
+        partner = np.where(np.abs(flightTime[before] - scienceTime) <= np.abs(flightTime[after] - scienceTime), before, after)
+        distance = np.abs(flightTime[partner] - scienceTime)
+        candidates = np.flatnonzero(distance <= tolerance)
+        candidates = candidates[np.lexsort((distance[candidates], partner[candidates]))]
+        first = np.ones(len(candidates), dtype=bool)
+        first[1:] = partner[candidates[1:]] != partner[candidates[:-1]]
+        shared[candidates[first]] = True
+    #
+    # Row of every sample in the merged record (flight rows first at equal times)
+    own = np.flatnonzero(~shared)
+    flightPosition = np.arange(len(flightTime)) + np.searchsorted(scienceTime[own], flightTime, side='left')
+    sciencePosition = np.empty(len(scienceTime), dtype=int)
+    sciencePosition[own] = np.arange(len(own)) + np.searchsorted(flightTime, scienceTime[own], side='right')
+    sciencePosition[shared] = flightPosition[partner[shared]]
+    nRows = len(flightTime) + len(own)
+    #
+    merged = {}
+    flightDtypes, scienceDtypes = dict(flight.dtypes), dict(science.dtypes)
+    for col in sorted(set(flightDtypes) | set(scienceDtypes)):
+        dtype = np.result_type(np.float32, *[dtypes[col] for dtypes in [flightDtypes, scienceDtypes] if col in dtypes])
+        column = np.full(nRows, np.nan, dtype=dtype)
+        if col in flightDtypes:
+            column[flightPosition] = flight[col].to_numpy()[flightRows]
+        if col in scienceDtypes:
+            values, position = science[col].to_numpy()[scienceRows], sciencePosition
+            if col in flightDtypes:
+                # the flight value of a shared row is kept
+                keep = np.isnan(column[position])
+                values, position = values[keep], position[keep]
+            column[position] = values
+        merged[col] = column
+    return pd.DataFrame(merged, copy=False)
+
+
 def processData(data, sourceInfo):
-    # Transform certain columns applying a function to them like "rad2deg"
-    def updateColumns(data, cols, func):
-        data.update({col: func(data[col])
-                    for col in cols if col in data.keys()})
+    # The glider variables are transformed in place in one float block with a contiguous column
+    # per variable, the layout of a pandas block, so the glider record frame is built on it without a copy
+    columns = list(data.columns)
+    position = {col: i for i, col in enumerate(columns)}
+    block = np.empty((len(data), len(columns)), order='F')
+    for i, col in enumerate(columns):
+        block[:, i] = data[col].to_numpy()
     #
 
-    def fillExactZeroWithNan(var):
-        # Ensure the array is of a float dtype before assigning NaN
-        # if np.issubdtype(var.dtype, np.integer):
-        var = var.astype(float)
-        var[np.isclose(var, 0, atol=1e-7)] = np.nan
-        return var
+    def blockColumns(cols):
+        return [block[:, position[col]] for col in cols if col in position]
     #
 
     def getColumnOrNan(df, columnName):
@@ -89,39 +215,43 @@ def processData(data, sourceInfo):
             return np.full(len(df), np.nan)
     #
     # Get rid of "zero's" that are measurement or initialization artefacts from sensors.
-    for col in data.columns:
-        data[col] = fillExactZeroWithNan(data[col].values)
-    #
-    # updateColumns(data, ['c_wpt_lat', 'c_wpt_lon',
-    #                      'm_gps_lat', 'm_gps_lon', 'm_lat', 'm_lon'], dm2d)
-    updateColumns(data, ['c_fin', 'c_heading', 'c_pitch',
-                         'm_fin', 'm_heading', 'm_pitch', 'm_roll'], np.degrees)
+    magnitude = np.empty(len(block))
+    isZero = np.empty(len(block), dtype=bool)
+    for values in blockColumns(columns):
+        np.less_equal(np.abs(values, out=magnitude), 1e-7, out=isZero)
+        values[isZero] = np.nan
+    #
+    # for values in blockColumns(['c_wpt_lat', 'c_wpt_lon',
+    #                             'm_gps_lat', 'm_gps_lon', 'm_lat', 'm_lon']): dm2d
+    for values in blockColumns(['c_fin', 'c_heading', 'c_pitch',
+                                'm_fin', 'm_heading', 'm_pitch', 'm_roll']):
+        np.degrees(values, out=values)
     #
     # Convert bar to dbar from glider pressure sensors (flight and science)
-    columnsToUpdate = ['sci_water_pressure', 'm_pressure']
-    for column in columnsToUpdate:
-        if column in data:
-            data[column] *= 10
+    for values in blockColumns(['sci_water_pressure', 'm_pressure']):
+        values *= 10
     #
     # Basic clipping of data
-    if np.all([k in data for k in ['m_gps_lat', 'm_gps_lon', 'm_lat', 'm_lon']]):
-        data.update({k: np.clip(data[k], *r) for k, r in zip(
-            ['m_gps_lat', 'm_gps_lon', 'm_lat', 'm_lon'], [(-90, 90), (-180, 180)] * 2)})
+    if np.all([k in position for k in ['m_gps_lat', 'm_gps_lon', 'm_lat', 'm_lon']]):
+        for values, r in zip(blockColumns(['m_gps_lat', 'm_gps_lon', 'm_lat', 'm_lon']), [(-90, 90), (-180, 180)] * 2):
+            np.clip(values, *r, out=values)
     #
-    if np.all([k in data for k in ['sci_water_cond', 'sci_water_temp', 'sci_water_pressure']]):
-        data.update({k: np.clip(data[k], *r) for k, r in zip(['sci_water_cond',
-                    'sci_water_temp', 'sci_water_pressure'], [(0, 7), (-1.9, 40), (-1.9, 1200)])})
+    if np.all([k in position for k in ['sci_water_cond', 'sci_water_temp', 'sci_water_pressure']]):
+        for values, r in zip(blockColumns(['sci_water_cond', 'sci_water_temp', 'sci_water_pressure']),
+                             [(0, 7), (-1.9, 40), (-1.9, 1200)]):
+            np.clip(values, *r, out=values)
     #
-    if 'sci_oxy4_oxygen' in data:
-        data['sci_oxy4_oxygen'] = np.clip(data['sci_oxy4_oxygen'], 0, 500)
+    for values in blockColumns(['sci_oxy4_oxygen']):
+        np.clip(values, 0, 500, out=values)
     #
-    if 'sci_water_pressure' in data:
-        data['sci_water_depth'] = p2depth(
-            data['sci_water_pressure'], time=data['time'], interpolate=True, tgap=5)
+    # Store the variables in the "gliderData" pd.dataframe
+    gliderData = pd.DataFrame(block, columns=columns, copy=False)
+    if 'sci_water_pressure' in gliderData:
+        gliderData['sci_water_depth'] = p2depth(
+            gliderData['sci_water_pressure'], time=gliderData['time'], interpolate=True, tgap=5)
     #
-    # Store and rename variables in the "data" pd.dataframe
-    gliderData = data.copy()
-    data = pd.DataFrame()
+    if not np.all([k in gliderData for k in ['sci_water_cond', 'sci_water_temp', 'sci_water_pressure', 'sci_water_depth']]):
+        return
     #
     # Copy/duplicate certain names to the data frame from the gliderData frame but fill with nan if not existing
     nameList = {
@@ -132,73 +262,66 @@ def processData(data, sourceInfo):
         'v': 'm_final_water_vy',
         'time_uv': 'time',
         'lat_uv': 'm_gps_lat',
-        'lon_uv': 'm_gps_lon'
+        'lon_uv': 'm_gps_lon',
+        'conductivity': 'sci_water_cond',
+        'temperature': 'sci_water_temp',
+        'depth': 'sci_water_depth',
+        'pressure': 'sci_water_pressure'
     }
+    data = pd.DataFrame({newCol: getColumnOrNan(gliderData, oldCol) for newCol, oldCol in nameList.items()}, copy=False)
     #
-    for newCol, oldCol in nameList.items():
-        data[newCol] = getColumnOrNan(gliderData, oldCol)
-    #
-    # derive CTD sensor data
-    if (np.all([k in gliderData for k in ['sci_water_cond', 'sci_water_temp', 'sci_water_pressure', 'sci_water_depth']])):
-        data['conductivity'], data['temperature'], data['depth'], data['pressure'] = gliderData[
-            'sci_water_cond'], gliderData['sci_water_temp'], gliderData['sci_water_depth'], gliderData['sci_water_pressure']
-        data['salinity'], data['absolute_salinity'], data['conservative_temperature'], data['density'] = deriveCTD(
-            data['conductivity'], data['temperature'], data['pressure'], data['lon'], data['lat'])
-    else:
-        return
+    # derive CTD and oxygen sensor data in one pass over the rows with a CTD sample
+    derived = {}
+    hasO2 = np.all([k in gliderData.keys() for k in ['sci_oxy4_oxygen', 'sci_water_temp', 'sci_water_pressure']])
+    derived['salinity'], derived['absolute_salinity'], derived['conservative_temperature'], derived['density'], O2 = deriveCTDO2(
+        data['conductivity'], data['temperature'], data['pressure'], data['lon'], data['lat'],
+        O2fresh=gliderData['sci_oxy4_oxygen'] if hasO2 else None, time=data['time'], tgap=20,
+        positions=sourceInfo.get('positions', 'mean'), workers=sourceInfo.get('threads', 1))
     #
     # FOR GDAC 3.0
-    data['lat_qc'] = data['lat']*0
-    data['lon_qc'] = data['lon']*0
-    data['depth_qc'] = data['depth']*0
+    derived['lat_qc'] = data['lat']*0
+    derived['lon_qc'] = data['lon']*0
+    derived['depth_qc'] = data['depth']*0
     #
-    # derive oxygen sensor data
-    if np.all([k in gliderData.keys() for k in ['sci_oxy4_oxygen', 'sci_water_temp', 'sci_water_pressure']]):
-        data['oxygen_concentration'] = deriveO2(
-            gliderData['sci_oxy4_oxygen'], gliderData['sci_water_temp'], data['salinity'], time=data['time'], interpolate=True, tgap=20)
+    if hasO2:
+        derived['oxygen_concentration'] = O2
     #
     if 'sci_oxy4_temp' in gliderData:
-        data['oxygen_sensor_temperature'] = gliderData['sci_oxy4_temp']
+        derived['oxygen_sensor_temperature'] = gliderData['sci_oxy4_temp']
     #
     # optical sensors (if present)
     chlorophyllList = ['sci_flbbrh_chlor_units', 'sci_flbbcd_chlor_units',
                        'sci_flbb_chlor_units', 'sci_flntu_chlor_units']
     for k in chlorophyllList:
         if k in gliderData:
-            data['chlorophyll_a'] = gliderData[k]
+            derived['chlorophyll_a'] = gliderData[k]
             break
     #
     cdomList = ['sci_fl3slo_cdom_unit', 'sci_fl3sloV2_cdom_units',
                 'sci_flbbcd_cdom_units', 'sci_fl2PeCdom_cdom_units']
     for k in cdomList:
         if k in gliderData:
-            data['cdom'] = gliderData[k]
+            derived['cdom'] = gliderData[k]
             break
+    data = data.assign(**derived)
     #
     # Quartod qc checks and with nans anywhere where the data is questionable for a rough qc
     qcList = ['temperature', 'salinity',
               'pressure', 'conductivity', 'density']
-    for k in qcList:
-        if k in data:
-            QCvariable = k + '_qc'
-            data[QCvariable] = quartodQCchecks(
-                data[k].values, data['time'].values, k)
+    QCflags = quartodQCbatch(data, data['time'].values,
+                             [k for k in qcList if k in data])
+    for QCvariable, QCflag in QCflags.items():
+        data[QCvariable] = QCflag
     #
     # Create profile id, profile_time, profile_lon and profile_lat variable
-    data = data.assign(profile_time=np.nan, profile_lat=np.nan,
-                       profile_lon=np.nan, profile_id=np.nan)
     prof_idx, prof_dir = findProfiles(
         data['time'], data['depth'], stall=20, shake=200)
-    uidx = np.unique(prof_idx)
-    for k in uidx:
-        if k == math.floor(k):
-            idx = prof_idx == k
-            idx = prof_idx == k
-            data.loc[idx, 'profile_time'] = data.loc[idx, 'time'].mean()
-            data.loc[idx, 'profile_lat'] = data.loc[idx, 'lat'].mean()
-            data.loc[idx, 'profile_lon'] = data.loc[idx, 'lon'].mean()
-            data.loc[idx, 'profile_id'] = prof_idx[idx] + \
-                sourceInfo['fileNumber']
+    profileTime, profileLat, profileLon = profileMeans(prof_idx, data['time'], data['lat'], data['lon'])
+    data = data.assign(profile_time=profileTime, profile_lat=profileLat, profile_lon=profileLon,
+                       profile_id=np.where(prof_idx == np.floor(prof_idx), prof_idx + sourceInfo['fileNumber'], np.nan))
+    #
+    # Compact types of the glider record (see attributes/dtype_policy.yml)
+    gliderData = compactFrame(gliderData)
     #
     # convert & save glider *.bd files to *.nc files
     saveNetcdf(data, gliderData, sourceInfo)
@@ -220,32 +343,24 @@ def main(sourceInfo):
     if sourceInfo['processingMode'] == 'delayed':
         flightVarFilter = readVarFilter('dbd_filter.csv')
         scienceVarFilter = readVarFilter('ebd_filter_ignore.csv')
-        flightData, ncFilename = readBDdata(
-            '%s%s' % (filename, ext), flightVarFilter)
-        scienceData, ncFilename = readBDdata(
-            '%s%s' % (filename, ext.replace('d', 'e', 1).replace('D', 'E', 1)), scienceVarFilter, ignore=True)
+        flightFile, scienceFile = segmentFiles(sourceInfo['bdFilename'], 'delayed')
+        flightData, ncFilename = readBDdata(flightFile, flightVarFilter)
+        scienceData, ncFilename = readBDdata(scienceFile, scienceVarFilter, ignore=True)
     elif sourceInfo['processingMode'] == 'realtime':
-        flightData = readBDdata(f'{filename}.sbd', None)
-        scienceData = readBDdata(f'{filename}.tbd', None)
+        flightFile, scienceFile = segmentFiles(sourceInfo['bdFilename'], 'realtime')
+        flightData, ncFilename = readBDdata(flightFile, None)
+        scienceData, ncFilename = readBDdata(scienceFile, None)
     else:
         raise ValueError(
             "Invalid processing mode. Supported modes are 'delayed' and 'realtime'.")
     #
-    # Merge records and sort by time
-    data = pd.concat([df for df in [flightData, scienceData]],
-                     ignore_index=True, sort=True)
+    # Merge the time ordered records
+    data = mergeRecords(flightData, scienceData, sourceInfo.get('mergeTolerance'))
     sourceInfo['ncFilename'] = "../nc/%s_%s.nc" % (
         ncFilename, sourceInfo['processingMode'])
-    if ('time' in data):
-        data = data.sort_values(by=['time'])
     if (data.empty):
         return
     #
-    #T  Remove bad times
-    data['time'][data['time'] > 2000000000] = np.nan  # T Remove bad times
-    data['time'][data['time'] < 1000000000] = np.nan  # T Remove bad times
-    data = data[~data['time'].isna()]
-    #
     # Check if the time values are monotonically increasing
     timeDiff = np.diff(data['time'].values)
     if not np.all(timeDiff > 0):
@@ -258,87 +373,341 @@ def main(sourceInfo):
         data['time'] = correctedTime
     #
     # Process and save data as netCDF
-    return processData(data, sourceInfo)
+    result = processData(data, sourceInfo)
+    if result is not None and 'resultFilename' in sourceInfo:
+        saveResult(sourceInfo['resultFilename'], *result, sourceInfo['ncFilename'])
+    return result
 
 
-#######################################################################
+def processSegment(sourceInfo):
+    """
+    Pool worker: processes one segment and publishes its frames in shared memory.
 
+    :param sourceInfo: dict, information about the segment (see main)
+    :return: dict, shared memory descriptor for attachFrames (empty if the frames are not returned), or None if the segment produced no data
+    """
+    result = main(sourceInfo)
+    if result is None:
+        return None
+    if not sourceInfo.get('returnFrames', True):
+        return {}  # the parent reads the stored segment result when it needs it
+    return publishFrames(data=result[0], gliderData=result[1])
 
-if __name__ == "__main__":
-    now = (datetime.utcnow()).strftime("%FT%TZ")
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--glider', help='glider name')
-    parser.add_argument('--mode', help='Processing mode (realtime | delayed)')
-    parser.add_argument('--metadataFile', help='Metadata file path')
-    args = parser.parse_args()
+def processMission(args, quickScan=False, pending=()):
+    """
+    One processing pass over the raw files of the mission (in the current directory): processes the new
+    or changed segments, updates the attributes of the others if the metadata changed, then updates the
+    trajectory file and the manifest.
 
+    :param args: argparse.Namespace, the command line options
+    :param quickScan: bool, reuse the recorded fingerprint of the raw files whose size and modification time didn't change
+    :param pending: set, raw files left out of the pass (e.g. segments still being transferred)
+    :return: list, names of the processed segments
+    """
+    now = (datetime.utcnow()).strftime("%FT%TZ")
     glider = args.glider
     processingMode = args.mode
     metadataFile = args.metadataFile
-
     encoderFile = "%s/attributes/glider_dac_3.0_conventions.yml" % scriptsDir
-
-    files = sorted(glob.glob('*.[dDtT][bBcC][dD]'))
+    files = sorted(glob.glob(RAW_PATTERN))
+    listed = [f for f in files if f not in pending]
+    #
+    # Only (re)process the segments whose raw files changed since the last run; the
+    # results of all other segments are read back from the manifest for the trajectory
+    manifestFilename = '../manifest.json'
+    manifest = loadManifest(manifestFilename)
+    trajectoryFilename = "../nc/%s_%s_trajectory.nc" % (glider, processingMode)
+    #
+    # A metadata or encoder change only rewrites the attributes of the files that are not reprocessed
+    attributesKey = attributeInputs("%s/%s" % (missionDir, metadataFile), encoderFile)
+    attributesChanged = manifest.get('attributes') != attributesKey
+    encoderChanged = (manifest.get('attributes') or {}).get('encoder') != attributesKey['encoder']
+    # parsed once here; the worker processes inherit the parsed files
+    readAttributes({'metadataFile': "%s/%s" % (missionDir, metadataFile), 'encoder': encoderFile})
+    # A new type policy changes the stored frames and files of every segment
+    dtypesKey = fileFingerprint(dtypePolicyFile)['sha1']
+    dtypesChanged = manifest.get('dtypes') != dtypesKey
+    # and so does another merge tolerance
+    mergeChanged = manifest.get('mergeTolerance') != args.mergeTolerance
+    # or positions
+    positionsChanged = manifest.get('positions', 'mean') != args.positions
+    segments = {}
     fileNumber = 1
     sourceInfos = []
+    refreshInfos = []
     for f in files:
         name, ext = os.path.splitext(f)
-        ncFilename = "../nc/%s_%s.nc" % (name, processingMode)
-        if not os.path.exists(ncFilename):
+        entry = manifest['segments'].get(name)
+        if f in pending:
+            # keeps its number and, if it has one, its current result until its files are complete
+            if entry is not None:
+                segments[name] = entry
+            fileNumber += 1
+            continue
+        inputs = segmentInputs(segmentFiles(f, processingMode), entry['inputs'] if quickScan and entry else None)
+        if not dtypesChanged and not mergeChanged and not positionsChanged and isSegmentCurrent(entry, inputs, fileNumber):
+            segments[name] = entry
+            if attributesChanged and entry['result'] is not None:
+                refreshInfos.append({
+                    'encoder': encoderFile,
+                    'dataType': 'profile',
+                    'metadataFile': "%s/%s" % (missionDir, metadataFile),
+                    'processingMode': processingMode,
+                    'bdFilename': f,
+                    'ncFilename': entry['ncFilename'],
+                    'datetime': now
+                })
+        else:
+            resultFilename = "../segments/%s_%s.result.npz" % (name, processingMode)
+            if os.path.exists(resultFilename):
+                os.remove(resultFilename)
+            segments[name] = {'inputs': inputs, 'fileNumber': fileNumber,
+                              'result': resultFilename, 'ncFilename': None}
             sourceInfos.append({
                 'encoder': encoderFile,
                 'dataType': 'profile',
                 'metadataFile': "%s/%s" % (missionDir, metadataFile),
                 'processingMode': processingMode,
                 'bdFilename': f,
-                'ncFilename': ncFilename,
+                'ncFilename': "../nc/%s_%s.nc" % (name, processingMode),
+                'resultFilename': resultFilename,
                 'missionDir': missionDir,
                 'fileNumber': fileNumber,
+                'returnFrames': not args.stream,
+                'mergeTolerance': args.mergeTolerance,
+                'positions': args.positions,
                 'datetime': now
             })
         #
         fileNumber += 1
     #
-    with multiprocessing.Pool(8) as p:
-        ALL = p.map(main, sourceInfos)
+    trajectoryKey = hashlib.sha1(json.dumps(
+        [trajectoryFilename, [[name, entry['inputs'], entry['fileNumber']] for name, entry in segments.items()]],
+        sort_keys=True).encode()).hexdigest()
+    trajectoryCurrent = not sourceInfos and manifest['trajectory'] == trajectoryKey and os.path.exists(trajectoryFilename)
+    if trajectoryCurrent and not attributesChanged:
+        print("No new file to process." if quickScan else "No new file to process.  Exiting now.")
+        return []
+    #
+    # Size the pool from the available cores and memory and run the largest segments first,
+    # keeping the estimated memory of the segments in flight under the budget.  Workers hand
+    # their frames back through shared memory and only return small descriptors, which are
+    # collected as soon as each segment is done.
+    workers, maxMemory = schedulerSettings(args.workers, args.maxMemory, len(sourceInfos))
+    # cores left over by the pool go to the threads of the CTD derivation
+    for info in sourceInfos:
+        info['threads'] = max(1, availableCores() // workers)
+    costs = [MEMORY_PER_RAW_BYTE * sum(fingerprint['size'] for fingerprint in segments[os.path.splitext(
+        info['bdFilename'])[0]]['inputs'].values()) for info in sourceInfos]
+    results = {}
+    startTracker()
+    with multiprocessing.Pool(workers) as p:
+        for info, descriptor in runScheduled(p, processSegment, sourceInfos, costs, maxMemory):
+            # Record what every (re)processed segment produced
+            name = os.path.splitext(info['bdFilename'])[0]
+            if descriptor is None:
+                segments[name].update(result=None)
+            else:
+                if descriptor:
+                    frames = attachFrames(descriptor)
+                    results[name] = (frames['data'], frames['gliderData'])
+                segments[name].update(ncFilename=loadMeta(info['resultFilename'])['ncFilename'])
+    #
+    if refreshInfos:
+        print("Metadata or encoder changed.  Updating the attributes of %d files." % len(refreshInfos))
+        with multiprocessing.Pool(schedulerSettings(args.workers, args.maxMemory, len(refreshInfos))[0]) as p:
+            p.starmap(refreshAttributes, [(info['ncFilename'], info, encoderChanged) for info in refreshInfos])
+    #
+    def segmentResult(name):
+        if name not in results:
+            data, gliderData, ncFilename = loadResult(segments[name]['result'])
+            return data, gliderData
+        return results[name]
     #
     # TRAJECTORY
-    allData = pd.concat([df[0] for df in ALL if df != None],
-                        ignore_index=True, sort=True).sort_values(by=['time']).reset_index()
-    allData = ignoreBadLatLon(allData)
-    allGliderData = pd.concat([df[1] for df in ALL if df != None],
-                              ignore_index=True, sort=True).sort_values(by=['time']).reset_index()
-    allGliderData = ignoreBadLatLon(allGliderData)
-    #
-    # REMOVE DUPLICATE ROWS (or profile_index is messed up!)
-    allData = allData.drop_duplicates(subset=['time'])
-    #
-    if 'x_dr_state' in allGliderData.keys() and np.all([key in allGliderData.keys() for key in ['m_gps_lon', 'm_gps_lat', 'm_lat', 'm_lon']]):
-        try:
-            allData['lon_qc'], allData['lat_qc'] = correctDeadReckoning(
-                allGliderData['m_lon'], allGliderData['m_lat'], allGliderData['time'], allGliderData['x_dr_state'], allGliderData['m_gps_lon'], allGliderData['m_gps_lat'])
-        except:
-            print("##  Dead Reckoning Correction FAILED.  No lon_qc/lat_qc generated.")
-    elif 'm_lat' in allGliderData and 'm_lon' in allGliderData:
-        allData['lon_qc'], allData['lat_qc'] = allGliderData['m_lon'], allGliderData['m_lat']
-    else:
-        printF('m_lat and/or m_lon not present in files -> NO Dead Reckoning Correction')
-    #
-    if 'depth' in allData.keys():
-        allData['profile_index'], allData['profile_direction'] = findProfiles(
-            allData['time'], allData['depth'], stall=20, shake=200)
-        allData['depth_qc'] = allData['depth']
-    #
     sourceInfo = {
         'metadataFile': "%s/%s" % (missionDir, metadataFile),
         'encoder': encoderFile,
         'processingMode': processingMode,
         'dataType': 'trajectory',
         'bdFilename': '',
-        'ncFilename': "../nc/%s_%s_trajectory.nc" % (glider, processingMode),
+        'ncFilename': trajectoryFilename,
         'missionDir': missionDir,
         'datetime': now,
-        'files': ','.join(files)+','+','.join(files).replace('dbd', 'ebd')
+        'files': ','.join(listed)+','+','.join(listed).replace('dbd', 'ebd')
     }
-    saveNetcdf(allData, allGliderData, sourceInfo)
+    #
+    # In append mode new segments that follow the end of the existing trajectory file are
+    # appended to it; anything else (changed or older segments, new variables) rebuilds it.
+    # If only the metadata or encoder changed, the attributes are rewritten in place
+    processed = [os.path.splitext(info['bdFilename'])[0] for info in sourceInfos]
+    withResult = [name for name in segments if segments[name]['result'] is not None]
+    updated = False
+    if trajectoryCurrent:
+        refreshAttributes(trajectoryFilename, sourceInfo, encoderChanged)
+        updated = True
+    elif args.append and manifest['trajectory'] is not None and os.path.exists(trajectoryFilename) and \
+            not any(name in manifest['segments'] for name in processed) and set(manifest['segments']) <= set(segments):
+        newResults = [segmentResult(name) for name in processed if name in withResult]
+        updated = not newResults or appendTrajectory(trajectoryFilename, newResults)
+        if not updated:
+            print("Trajectory can't be extended with the new segments.  Rebuilding it.")
+        elif attributesChanged:
+            refreshAttributes(trajectoryFilename, sourceInfo, encoderChanged)
+    #
+    if not updated and args.stream:
+        streamTrajectory([segments[name]['result'] for name in withResult], sourceInfo)
+    elif not updated:
+        allData, allGliderData = buildTrajectory([segmentResult(name) for name in withResult])
+        saveNetcdf(allData, allGliderData, sourceInfo)
+    #
+    manifest['segments'] = segments
+    manifest['trajectory'] = trajectoryKey
+    manifest['attributes'] = attributesKey
+    manifest['dtypes'] = dtypesKey
+    manifest['mergeTolerance'] = args.mergeTolerance
+    manifest['positions'] = args.positions
+    saveManifest(manifestFilename, manifest)
+    return processed
+
+
+def rawListing(directory='.'):
+    """
+    Size and modification time of the files of a directory, from one scan.
+
+    :param directory: str, the directory
+    :return: dict, (size, mtime in ns) by file name
+    """
+    listing = {}
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            stat = entry.stat()
+            listing[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return listing
+
+
+def linkCacheFiles(cacheDir):
+    """
+    Lower case links to the sensor cache files (needed by dbdreader), like run.sh makes before each run.
+
+    :param cacheDir: str, the sensor cache directory
+    """
+    if not os.path.isdir(cacheDir):
+        return
+    for entry in os.scandir(cacheDir):
+        lower = entry.name.lower()
+        if lower != entry.name and not os.path.lexists(os.path.join(cacheDir, lower)):
+            os.symlink(entry.name, os.path.join(cacheDir, lower))
+
+
+def servicePass(args, pending):
+    """
+    One pass of the service, in a process forked from it: the process has the modules imported and the
+    metadata parsed, but none of the memory of the previous passes (a long-lived process that processed
+    them runs a pass more slowly than a new one).
+
+    :param args: argparse.Namespace, the command line options
+    :param pending: set, raw files left out of the pass
+    """
+    start = time.time()
+    try:
+        processed = processMission(args, quickScan=True, pending=pending)
+        print("%s: %d segments processed in %.1f s" % (
+            datetime.utcnow().strftime("%FT%TZ"), len(processed), time.time() - start))
+    except Exception:
+        traceback.print_exc()  # retried when the files change
+    sys.stdout.flush()
+
+
+def watchMission(args):
+    """
+    Service mode: polls the raw directory (the current directory) and processes the new or changed
+    segments as soon as both of their files are there, with the modules imported and the metadata parsed
+    once.  Every pass runs in a process forked from the service (see servicePass), so it starts from the
+    same state as the first one and nothing builds up between passes.  Files still being written
+    (changed since the previous poll) are waited for; a lone half is processed on its own once it is
+    PAIR_WAIT seconds old.  Runs until interrupted.
+
+    :param args: argparse.Namespace, the command line options
+    """
+    encoderFile = "%s/attributes/glider_dac_3.0_conventions.yml" % scriptsDir
+    inputs = ("%s/%s" % (missionDir, args.metadataFile), encoderFile)
+    # parsed before the workers are forked, so they start with it
+    readAttributes({'metadataFile': inputs[0], 'encoder': inputs[1]})
+    startTracker()
+    previous, done = None, None
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    printF("Watching %s for new segments every %g s." % (os.getcwd(), args.interval))
+    while True:
+        listing = rawListing()
+        linkCacheFiles(sensorCacheDir)
+        if listing == previous:
+            # nothing is being written: process the segments whose files are all there
+            pending = set()
+            for f in fnmatch.filter(listing, RAW_PATTERN):
+                if not all(half in listing for half in segmentFiles(f, args.mode)) and \
+                        time.time() - listing[f][1] / 1e9 < PAIR_WAIT:
+                    pending.add(f)
+            try:
+                mtimes = [os.stat(f).st_mtime_ns for f in inputs]
+            except OSError:
+                # e.g. the metadata file being replaced: the pass fails and is retried when it is back
+                mtimes = None
+            state = (listing, pending, mtimes)
+            if state != done:
+                process = multiprocessing.Process(target=servicePass, args=(args, pending))
+                process.start()
+                try:
+                    process.join()
+                finally:
+                    if process.is_alive():
+                        process.terminate()
+                        process.join()
+                done = state
+        previous = listing
+        time.sleep(args.interval)
+
+
+#######################################################################
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--glider', help='glider name')
+    parser.add_argument('--mode', help='Processing mode (realtime | delayed)')
+    parser.add_argument('--metadataFile', help='Metadata file path')
+    parser.add_argument('--append', action='store_true',
+                        help='Append new segments to the existing trajectory file instead of rebuilding it (realtime)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Build the trajectory file from the stored segment results in bounded memory')
+    parser.add_argument('--workers', type=int,
+                        help='Number of worker processes (default: available cores, limited by memory)')
+    parser.add_argument('--reqc', action='store_true',
+                        help='Rerun the QC tests on the existing nc files and rewrite their *_qc variables only')
+    parser.add_argument('--mergeTolerance', type=float,
+                        help='Science samples within this many seconds of a flight sample share its row (default: no sharing)')
+    parser.add_argument('--positions', choices=['mean', 'interpolate'], default='mean',
+                        help='Position used for the absolute salinity: segment mean or interpolated in time (default: mean)')
+    parser.add_argument('--max-memory', dest='maxMemory',
+                        help='Memory budget of the segments processed at once, e.g. 8G (default: 80%% of the available memory)')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and process new segments as they arrive in the raw directory (realtime service)')
+    parser.add_argument('--interval', type=float, default=2,
+                        help='Seconds between two polls of the raw directory with --watch (default: 2)')
+    args = parser.parse_args()
+    #
+    # Apply new QC thresholds to the existing files only
+    if args.reqc:
+        manifest = loadManifest('../manifest.json')
+        ncFilenames = sorted(glob.glob("../nc/*_%s.nc" % args.mode))
+        resultFilenames = {entry['ncFilename']: entry['result'] for entry in manifest['segments'].values()
+                           if entry.get('result') is not None}
+        workers, maxMemory = schedulerSettings(args.workers, args.maxMemory, len(ncFilenames))
+        reqcFiles(ncFilenames, "../nc/%s_%s_trajectory.nc" % (args.glider, args.mode), resultFilenames, workers)
+        sys.exit(0)
+    #
+    if args.watch:
+        watchMission(args)
+    else:
+        processMission(args)
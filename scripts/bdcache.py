@@ -0,0 +1,175 @@
+import os
+import json
+import hashlib
+import zipfile
+import numpy as np
+import pandas as pd
+
+CACHE_VERSION = 1
+
+
+def fileFingerprint(filename):
+	"""
+	Fingerprint of a raw glider file: size, modification time and content hash.
+
+	Args:
+		filename (str): path to the file.
+
+	Returns:
+		dict with 'size', 'mtime' and 'sha1' keys.
+	"""
+	stat = os.stat(filename)
+	sha1 = hashlib.sha1()
+	with open(filename, 'rb') as fid:
+		for block in iter(lambda: fid.read(1 << 20), b''):
+			sha1.update(block)
+	return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}
+
+
+def listFingerprint(items):
+	"""
+	Order-sensitive hash of a list of strings (e.g. a variable filter).
+	"""
+	if items is None:
+		return None
+	return hashlib.sha1('\n'.join(items).encode()).hexdigest()
+
+
+def cacheDirFingerprint(cacheDir):
+	"""
+	Hash of the sensor cache file set (*.cac) used by dbdreader to decode the files.
+	Upper and lower case copies of the same cache file are counted once.
+	"""
+	if not os.path.isdir(cacheDir):
+		return None
+	entries = {}
+	for entry in os.scandir(cacheDir):
+		name = entry.name.lower()
+		if name.endswith('.cac') and entry.is_file():
+			entries[name] = entry.stat().st_size
+	return listFingerprint(['%s:%d' % item for item in sorted(entries.items())])
+
+
+def saveFrames(filename, meta=None, **frames):
+	"""
+	Stores data frames column by column in an uncompressed *.npz file.
+
+	Args:
+		filename (str): output file path (written atomically).
+		meta (dict): JSON-serializable information stored next to the data.
+		**frames: pd.DataFrame objects to store, keyed by name.
+	"""
+	arrays = {'__meta__': np.array(json.dumps(meta if meta is not None else {}))}
+	for name, frame in frames.items():
+		arrays['%s/__columns__' % name] = np.array(list(frame.columns), dtype=str)
+		for iCol, col in enumerate(frame.columns):
+			arrays['%s/%d' % (name, iCol)] = frame[col].to_numpy()
+	os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+	tmpFilename = '%s.%d.tmp' % (filename, os.getpid())
+	with open(tmpFilename, 'wb') as fid:
+		np.savez(fid, **arrays)
+	os.replace(tmpFilename, filename)
+
+
+def loadMeta(filename):
+	"""
+	Reads only the information dictionary of a file written by saveFrames.
+	"""
+	with np.load(filename, allow_pickle=False) as npz:
+		return json.loads(str(npz['__meta__']))
+
+
+def loadFrames(filename, names=None, columns=None):
+	"""
+	Reads data frames written by saveFrames.
+
+	Args:
+		filename (str): *.npz file path.
+		names (list): frame names to load (default: all of them).
+		columns (list): column names to load (default: all of them); only these columns are read from disk.
+
+	Returns:
+		meta (dict), frames (dict of pd.DataFrame)
+	"""
+	frames = {}
+	with np.load(filename, allow_pickle=False) as npz:
+		meta = json.loads(str(npz['__meta__']))
+		for key in npz.files:
+			if not key.endswith('/__columns__'):
+				continue
+			name = key[:-len('/__columns__')]
+			if names is not None and name not in names:
+				continue
+			selected = [(iCol, col) for iCol, col in enumerate(npz[key].tolist()) if columns is None or col in columns]
+			frames[name] = pd.DataFrame({col: npz['%s/%d' % (name, iCol)] for iCol, col in selected},
+										columns=[col for iCol, col in selected], copy=False)
+	return meta, frames
+
+
+def frameLayout(filename):
+	"""
+	Column names, types and lengths of the data frames in a file written by saveFrames,
+	read from the array headers without loading any data.
+
+	Returns:
+		dict of lists of (column, dtype, rows) tuples, keyed by frame name.
+	"""
+	layout = {}
+	with np.load(filename, allow_pickle=False) as npz:
+		names = {key[:-len('/__columns__')]: npz[key].tolist() for key in npz.files if key.endswith('/__columns__')}
+	with zipfile.ZipFile(filename) as zf:
+		for name, columns in names.items():
+			layout[name] = []
+			for iCol, col in enumerate(columns):
+				with zf.open('%s/%d.npy' % (name, iCol)) as fid:
+					version = np.lib.format.read_magic(fid)
+					if version == (1, 0):
+						shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(fid)
+					else:
+						shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(fid)
+				layout[name].append((col, dtype, shape[0]))
+	return layout
+
+
+def segmentKey(filename, varFilter, ignore, cacheDir):
+	"""
+	Everything a decoded segment depends on: the raw file, the variable filter and the sensor cache files.
+	"""
+	return {
+		'version': CACHE_VERSION,
+		'file': fileFingerprint(filename),
+		'filter': listFingerprint(varFilter),
+		'ignore': bool(ignore),
+		'cache': cacheDirFingerprint(cacheDir),
+	}
+
+
+def segmentCacheFilename(filename, segmentDir):
+	return os.path.join(segmentDir, os.path.basename(filename) + '.npz')
+
+
+def readCachedBD(filename, key, segmentDir):
+	"""
+	Returns the decoded (data, ncFilename) of a raw file from the segment cache, or None if
+	there is no cached copy or it was produced from a different file, filter or cache set.
+	"""
+	cacheFilename = segmentCacheFilename(filename, segmentDir)
+	if not os.path.isfile(cacheFilename):
+		return None
+	try:
+		if loadMeta(cacheFilename).get('key') != key:
+			return None
+		meta, frames = loadFrames(cacheFilename)
+		return frames['data'], meta['ncFilename']
+	except Exception:
+		return None
+
+
+def writeCachedBD(filename, key, segmentDir, data, ncFilename):
+	"""
+	Stores the decoded data of a raw file in the segment cache.
+	"""
+	try:
+		saveFrames(segmentCacheFilename(filename, segmentDir), {'key': key, 'ncFilename': ncFilename}, data=data)
+	except OSError as e:
+		print("Warning: could not write segment cache for %s (%s)" % (filename, e))
@@ -1,9 +1,180 @@
 import numpy as np
+import pandas as pd
 from datetime import datetime
 import math
+import re
 import yaml
 import os
 import xarray as xr
+import netCDF4
+from dtypepolicy import stateFills
+
+
+# Variables added by dataAttributes for the GDAC (not from the data)
+ANCILLARY_VARIABLES = ('platform', 'instrument_ctd', 'trajectory', 'traj_strlen')
+
+
+# Parsed metadata and encoder files and compiled '** COMMAND:' expressions, kept for the whole run
+# (workers forked after the first read inherit them)
+_attributes = {}
+_commands = {}
+
+# Reducers for the usual '** COMMAND:' expressions, applied to the values of one variable
+COMMAND_REDUCERS = [
+	(re.compile(r"np\.nanmin\(data\['(\w+)'\](?:\.values)?\)"), np.nanmin),
+	(re.compile(r"np\.nanmax\(data\['(\w+)'\](?:\.values)?\)"), np.nanmax),
+	(re.compile(r"np\.absolute\(np\.nanmedian\(np\.diff\(data\['(\w+)'\](?:\.values)?\)\)\)"),
+		lambda values: np.absolute(np.nanmedian(np.diff(values)))),
+]
+
+
+def readAttributes(sourceInfo):
+	"""
+	Reads the mission metadata and the IOOS encoder (variable naming rules and attributes) and merges them.
+	The files are parsed once per process (and again only if they change); the result must not be modified.
+	"""
+	key = tuple((f, os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in (sourceInfo['metadataFile'], sourceInfo['encoder']))
+	if key not in _attributes:
+		with open(sourceInfo['metadataFile'], 'r') as f:
+			missionMeta = yaml.load(f, Loader=yaml.BaseLoader)
+		with open(sourceInfo['encoder'], 'r') as f:
+			cfl = yaml.load(f, Loader=yaml.BaseLoader)
+		# Merge dictionaries from master yaml and IOOS Decoder
+		_attributes.clear()
+		_attributes[key] = {**missionMeta, **cfl}
+	return _attributes[key]
+
+
+def compileCommand(command):
+	"""
+	Turns a '** COMMAND:' expression into a function of the dataset, once per process: a reducer
+	of one variable for the usual expressions (see COMMAND_REDUCERS), otherwise the compiled
+	expression, evaluated with numpy ('np') and the dataset ('data') only.
+	"""
+	if command not in _commands:
+		for pattern, reducer in COMMAND_REDUCERS:
+			match = pattern.fullmatch(command.strip())
+			if match:
+				_commands[command] = lambda data, var=match.group(1), reducer=reducer: reducer(data[var].values)
+				break
+		else:
+			code = compile(command.strip(), '<encoder>', 'eval')
+			_commands[command] = lambda data, code=code: eval(code, {'np': np, '__builtins__': {}}, {'data': data})
+	return _commands[command]
+
+
+def globalAttributes(attrs, sourceInfo):
+	"""
+	Global attributes of a file: the user input from the metadata and the processing information.
+
+	Args:
+	attrs (dict): merged metadata and encoder (see readAttributes).
+	sourceInfo (dict): Information about the Dataset and processing mode
+
+	Returns:
+	dict of attributes.
+	"""
+	globalAttrs = {}
+	##  USER INPUT
+	for key in attrs['global'].keys():
+		value = attrs['global'][key]
+		# if(type(value) == datetime.datetime or type(value) == datetime.date):
+			# globalAttrs[key] = value.strftime('%FT%X')
+		# else:
+		globalAttrs[key] = value
+	#
+	##  CALCULATED
+	globalAttrs['processingMode'] = sourceInfo['processingMode']
+	globalAttrs['cdm_dataType'] = sourceInfo['dataType']
+	globalAttrs['history'] = '%s: %s' % (sourceInfo['datetime'], "This file was created using the Python Glider Processing Toolbox.")
+	if('files' in sourceInfo.keys()):
+		globalAttrs['history'] += "  Glider files: " + sourceInfo['files']
+		
+	#
+	if any('/' in file or '\\' in file for file in sourceInfo['bdFilename']):
+		# Use os.path.basename() to get only the file names
+		file_names = [os.path.basename(file) for file in sourceInfo['bdFilename']]
+		globalAttrs['source'] = ', '.join(file_names)
+	else:
+		globalAttrs['source'] = sourceInfo['bdFilename']
+	#
+	processing_levels = {
+		('realtime', 'profile'): 'Realtime raw Slocum glider profile data converted from the native data file format. No quality control provided.',
+		('realtime', 'trajectory'): 'Realtime raw Slocum glider trajectory data converted and concatenated from the native data file format. No quality control provided.',
+		('delayed', 'profile'): 'Delayed mode Slocum glider profile data converted from the native format. Limited and provisional quality control provided.',
+		('delayed', 'trajectory'): 'Delayed mode Slocum glider trajectory data converted and concatenated from the complete data set. Limited and provisional quality control provided.',
+	}
+	processing_key = (sourceInfo['processingMode'], sourceInfo['dataType'])
+	globalAttrs['processing_level'] = processing_levels.get(processing_key, 'Unknown processing level')
+	return globalAttrs
+
+
+def variableAttributes(attrs, variables, dataVariables, evaluate):
+	"""
+	Variable attributes from the CF namelist of the encoder; variables without a long name get fillers.
+
+	Args:
+	attrs (dict): merged metadata and encoder (see readAttributes).
+	variables (list): names of all the variables (and coordinates) in the file.
+	dataVariables (list): names of the data variables.
+	evaluate (function): evaluate(var, key, command) returns the value of a '** COMMAND:' attribute.
+
+	Returns:
+	dict of attribute dicts, keyed by variable name.
+	"""
+	varAttrs = {var: {} for var in dataVariables}
+	for var in attrs['CFnamelist'].keys():
+		if(var in variables):
+			for key in attrs['CFnamelist'][var].keys():
+				if(attrs['CFnamelist'][var][key].startswith('** COMMAND:')):
+					command = attrs['CFnamelist'][var][key].replace('** COMMAND:','')
+					varAttrs.setdefault(var, {})[key] = evaluate(var, key, command)
+				else:
+					varAttrs.setdefault(var, {})[key] = attrs['CFnamelist'][var][key]
+	##  Fill the rest of variables attributes with fillers
+	for var in dataVariables:
+		if("long_name" not in varAttrs[var].keys()):
+			varAttrs[var]['standard_name'] = var
+			varAttrs[var]['long_name'] = var
+			varAttrs[var]['units'] = ' '
+			varAttrs[var]['comment'] = ' '
+			varAttrs[var]['observation_type'] = ' '
+			varAttrs[var]['accuracy'] = ' '
+			varAttrs[var]['platform'] = 'platform'
+	return varAttrs
+
+
+def ancillaryAttributes(attrs, globalAttrs):
+	"""
+	Attributes of the platform, instrument and trajectory variables (see ANCILLARY_VARIABLES).
+	"""
+	ancillary = {}
+	ancillary['platform'] = {
+		"_FillValue": -999,
+		"comment": attrs['glider']['comment'], # "%s %s" % (attrs['glider']['type'],attrs['glider']['seial']),
+		"id": attrs['glider']['name'],
+		"instrument": "instrument_ctd",
+		"long_name": "Memorial University %s %s" % (attrs['glider']['type'],attrs['glider']['name']),
+		"type" : "platform",
+		"wmo_id":attrs['glider']['WMO']
+	}
+	#
+	# CTD
+	ancillary['instrument_ctd'] = {}
+	for key in attrs['sensors']['CTD'].keys():
+		value = attrs['sensors']['CTD'][key]
+		ancillary['instrument_ctd'][key] = value
+	ancillary['instrument_ctd']['_FillValue'] = -999
+	#
+	ancillary['trajectory'] = {
+		'cf_role': 'trajectory_id',
+		'comment': "A trajectory is a single deployment of a glider and may span multiple data files.",
+		"long_name": "Trajectory %s" % globalAttrs['id']
+	}
+	ancillary['traj_strlen'] = {
+		"long_name": "Trajectory String Length"
+	}
+	return ancillary
 
 
 def dataAttributes(data, sourceInfo):
@@ -21,12 +192,7 @@ def dataAttributes(data, sourceInfo):
 	now = datetime.utcnow().strftime('%FT%TZ')
 	#
 	##  READ ATTRIBUTES AND VARIABLE NAMING RULES (ENCODER)
-	with open(sourceInfo['metadataFile'], 'r') as f:
-		missionMeta = yaml.load(f, Loader=yaml.BaseLoader)
-	with open(sourceInfo['encoder'], 'r') as f:
-		cfl = yaml.load(f, Loader=yaml.BaseLoader)
-	# Merge dictionaries from master yaml and IOOS Decoder
-	attrs = {**missionMeta, **cfl}
+	attrs = readAttributes(sourceInfo)
 	#
 	#####################  AUTO CALCULATE  #####################
 	##  FROM NC FILE
@@ -48,79 +214,26 @@ def dataAttributes(data, sourceInfo):
 	duration += "%dS" % durationSeconds
 	#
 	#####################  ADD ATTRIBUTES  #####################
-	##  USER INPUT
-	for key in attrs['global'].keys():
-		value = attrs['global'][key]
-		# if(type(value) == datetime.datetime or type(value) == datetime.date):
-			# data.attrs[key] = value.strftime('%FT%X')
-		# else:
-		data.attrs[key] = value
-	#
-	##  CALCULATED
-	data.attrs['processingMode'] = sourceInfo['processingMode']
-	data.attrs['cdm_dataType'] = sourceInfo['dataType']
-	data.attrs['history'] = '%s: %s' % (sourceInfo['datetime'], "This file was created using the Python Glider Processing Toolbox.")
-	if('files' in sourceInfo.keys()):
-		data.attrs['history'] += "  Glider files: " + sourceInfo['files']
-		
-	#
-	if any('/' in file or '\\' in file for file in sourceInfo['bdFilename']):
-		# Use os.path.basename() to get only the file names
-		file_names = [os.path.basename(file) for file in sourceInfo['bdFilename']]
-		data.attrs['source'] = ', '.join(file_names)
-	else:
-		data.attrs['source'] = sourceInfo['bdFilename']
-	#
-	processing_levels = {
-		('realtime', 'profile'): 'Realtime raw Slocum glider profile data converted from the native data file format. No quality control provided.',
-		('realtime', 'trajectory'): 'Realtime raw Slocum glider trajectory data converted and concatenated from the native data file format. No quality control provided.',
-		('delayed', 'profile'): 'Delayed mode Slocum glider profile data converted from the native format. Limited and provisional quality control provided.',
-		('delayed', 'trajectory'): 'Delayed mode Slocum glider trajectory data converted and concatenated from the complete data set. Limited and provisional quality control provided.',
-	}
-	processing_key = (sourceInfo['processingMode'], sourceInfo['dataType'])
-	data.attrs['processing_level'] = processing_levels.get(processing_key, 'Unknown processing level')
+	data.attrs.update(globalAttributes(attrs, sourceInfo))
 	#
 	#####################  ADD VARIABLE ATTRIBUTES FROM THE CF NAMELIST #####################
 	for var in attrs['CFnamelist'].keys():
-		if(var in data):
-			for key in attrs['CFnamelist'][var].keys():
-				if(attrs['CFnamelist'][var][key].startswith('** COMMAND:')):
-					command = attrs['CFnamelist'][var][key].replace('** COMMAND:','')
-					data[var].attrs[key] = eval(command)
-				else:
-					data[var].attrs[key] = attrs['CFnamelist'][var][key]
-		else:
+		if(var not in data):
 			print('%s not present in the data file' % var)
-	##  Fill the rest of variables attributes with fillers
-	for var in data.keys():
-		if("long_name" not in data[var].attrs.keys()):
-			data[var].attrs['standard_name'] = var
-			data[var].attrs['long_name'] = var
-			data[var].attrs['units'] = ' '
-			data[var].attrs['comment'] = ' '
-			data[var].attrs['observation_type'] = ' '
-			data[var].attrs['accuracy'] = ' '
-			data[var].attrs['platform'] = 'platform'
+	varAttrs = variableAttributes(attrs, list(data.variables), list(data.keys()),
+								  lambda var, key, command: compileCommand(command)(data))
+	for var in varAttrs.keys():
+		data[var].attrs.update(varAttrs[var])
+	ancillary = ancillaryAttributes(attrs, data.attrs)
 	#
 	data['platform'] = 0
-	data['platform'].attrs = {
-		"_FillValue": -999,
-		"comment": attrs['glider']['comment'], # "%s %s" % (attrs['glider']['type'],attrs['glider']['seial']),
-		"id": attrs['glider']['name'],
-		"instrument": "instrument_ctd",
-		"long_name": "Memorial University %s %s" % (attrs['glider']['type'],attrs['glider']['name']),
-		"type" : "platform",
-		"wmo_id":attrs['glider']['WMO']
-	}
+	data['platform'].attrs = ancillary['platform']
 	data['platform'] = data['platform'].astype(np.int32) ##  To get rid of "LL" in netCDF
 	#
 	# CTD
 	data['instrument_ctd'] = 0
 	data['instrument_ctd'] = data['instrument_ctd'].astype(np.int32) ##  To get rid of "LL" in netCDF
-	for key in attrs['sensors']['CTD'].keys():
-		value = attrs['sensors']['CTD'][key]
-		data['instrument_ctd'].attrs[key] = value
-	data['instrument_ctd'].attrs['_FillValue'] = -999
+	data['instrument_ctd'].attrs = ancillary['instrument_ctd']
 	
   	#
 	# Specific data types wanted by IOOS
@@ -134,18 +247,266 @@ def dataAttributes(data, sourceInfo):
 	x = xr.Dataset({"trajectory": (("traj_strlen"), [1234])},
 		coords={"traj_strlen": [1]})
 	data = xr.combine_by_coords([data, x])
-	data['trajectory'].attrs = {
-		'cf_role': 'trajectory_id',
-		'comment': "A trajectory is a single deployment of a glider and may span multiple data files.",
-        "long_name": "Trajectory %s" % data.attrs['id']
-	}
-	data['traj_strlen'].attrs = {
-        "long_name": "Trajectory String Length"
-	}
+	data['trajectory'].attrs = ancillary['trajectory']
+	data['traj_strlen'].attrs = ancillary['traj_strlen']
 	#
 	return data
 
-def saveNetcdf(data, gliderData, sourceInfo):
+def refreshDataAttributes(ncFilename, sourceInfo):
+	"""
+	Re-evaluates the data dependent variable attributes ('** COMMAND:' entries of the encoder, e.g.
+	valid_min/valid_max) of an existing netCDF file in place.  Variables are read one at a time.
+	
+	Args:
+	ncFilename (str): path of the netCDF file.
+	sourceInfo (dict): Information about the Dataset and processing mode
+	"""
+	cfl = readAttributes(sourceInfo)
+	#
+	values = {}
+	with xr.open_dataset(ncFilename, decode_times=False) as data:
+		for var in cfl['CFnamelist'].keys():
+			if(var in data):
+				for key in cfl['CFnamelist'][var].keys():
+					if(cfl['CFnamelist'][var][key].startswith('** COMMAND:')):
+						command = cfl['CFnamelist'][var][key].replace('** COMMAND:','')
+						values.setdefault(var, {})[key] = np.asarray(compileCommand(command)(data))[()]
+	#
+	with netCDF4.Dataset(ncFilename, 'a') as nc:
+		for var, attrs in values.items():
+			for key, value in attrs.items():
+				nc[var].setncattr(key, value)
+
+def refreshAttributes(ncFilename, sourceInfo, evaluate=True):
+	"""
+	Rewrites the global and variable attributes of an existing netCDF file in place from the current
+	metadata and encoder, as dataAttributes would set them, without rewriting any data.
+	
+	Args:
+	ncFilename (str): path of the netCDF file.
+	sourceInfo (dict): Information about the Dataset and processing mode
+	evaluate (bool): re-evaluate the '** COMMAND:' attributes (only needed if the encoder changed);
+		otherwise their stored values are kept and only missing ones are evaluated, reading just the
+		variables they use.
+	"""
+	attrs = readAttributes(sourceInfo)
+	with netCDF4.Dataset(ncFilename, 'r') as nc:
+		variables = [var for var in nc.variables if var not in ANCILLARY_VARIABLES]
+		stored = {var: {key: nc[var].getncattr(key) for key in nc[var].ncattrs()} for var in variables}
+	dataVariables = [var for var in variables if var != 'time']
+	#
+	datasets = []
+	def evaluateCommand(var, key, command):
+		if not evaluate and key in stored[var]:
+			return stored[var][key]
+		if not datasets:
+			datasets.append(xr.open_dataset(ncFilename, decode_times=False))
+		return np.asarray(compileCommand(command)(datasets[0]))[()]
+	try:
+		globalAttrs = globalAttributes(attrs, sourceInfo)
+		varAttrs = variableAttributes(attrs, variables, dataVariables, evaluateCommand)
+	finally:
+		for dataset in datasets:
+			dataset.close()
+	varAttrs.update(ancillaryAttributes(attrs, globalAttrs))
+	#
+	# Remove and re-add the attributes so that their order is the same as in a new file
+	# (the fill value is part of the data definition and can't change)
+	with netCDF4.Dataset(ncFilename, 'a') as nc:
+		for key in nc.ncattrs():
+			nc.delncattr(key)
+		nc.setncatts(globalAttrs)
+		for var, varAttr in varAttrs.items():
+			if var not in nc.variables:
+				continue
+			for key in nc[var].ncattrs():
+				if key != '_FillValue':
+					nc[var].delncattr(key)
+			nc[var].setncatts({key: value for key, value in varAttr.items() if key != '_FillValue'})
+
+# Compression, chunking and stored types of the output files (per output kind)
+outputSettingsFile = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'attributes', 'netcdf_output.yml')
+_outputSettings = {}
+
+
+def outputSettings(sourceInfo, filename=None):
+	"""
+	Output settings of a file: the 'default' entry of the settings file updated with the entry of the
+	output kind ('<processingMode>_<dataType>', e.g. 'realtime_profile').  Read once per process.
+
+	Returns:
+	dict with 'complevel', 'shuffle', 'chunk', 'dtypes' and 'gliderRecord'.
+	"""
+	if filename is None:
+		filename = outputSettingsFile
+	mtime = os.path.getmtime(filename)
+	if filename not in _outputSettings or _outputSettings[filename][0] != mtime:
+		with open(filename, 'r') as f:
+			_outputSettings[filename] = (mtime, yaml.safe_load(f))
+	table = _outputSettings[filename][1]
+	settings = dict(table['default'])
+	settings.update(table.get('%s_%s' % (sourceInfo['processingMode'], sourceInfo['dataType'])) or {})
+	return settings
+
+
+def requireDimension(nc, dim, size, unlimitedDims):
+	"""
+	Creates a dimension in a file or group, unless a parent group (e.g. the root of the glider record)
+	already has it with the same size.  A group with another number of rows gets its own dimension
+	(unlimited too if the name is in unlimitedDims), so it never extends the rows of the parent.
+	"""
+	group = nc
+	while group is not None:
+		if dim in group.dimensions:
+			if len(group.dimensions[dim]) == size:
+				return
+			break
+		group = group.parent
+	if dim not in nc.dimensions:
+		nc.createDimension(dim, None if dim in unlimitedDims else size)
+
+
+def writeGroup(nc, dataset, encoding, unlimitedDims):
+	"""
+	Writes an xarray Dataset into an open netCDF4 file or group, encoded as xarray's to_netcdf does
+	(CF encoding, fill values, attributes in order).
+
+	Args:
+	nc (netCDF4.Dataset or netCDF4.Group): target.
+	dataset (xr.Dataset): variables to write.
+	encoding (dict): createVariable options (compression, chunk sizes) per variable name.
+	unlimitedDims (list): names of the unlimited dimensions.
+	"""
+	variables, attrs = xr.conventions.cf_encoder(dict(dataset.variables), dataset.attrs)
+	nc.setncatts(attrs)
+	#
+	for var in variables.values():
+		for dim, size in zip(var.dims, var.shape):
+			requireDimension(nc, dim, size, unlimitedDims)
+	#
+	for name, var in variables.items():
+		varAttrs = dict(var.attrs)
+		fillValue = varAttrs.pop('_FillValue', None)
+		ncVar = nc.createVariable(name, str if var.dtype.kind in 'OU' else var.dtype, var.dims,
+								  fill_value=fillValue, **encoding.get(name, {}))
+		ncVar.set_auto_maskandscale(False)
+		ncVar.setncatts(varAttrs)
+		ncVar[...] = var.values
+
+
+def isGathered(group, name):
+	"""
+	True if a variable of the glider record is stored compressed by gathering (see writeGathered).
+	"""
+	dims = group[name].dimensions
+	return len(dims) == 1 and dims[0] != name and dims[0] in group.variables and 'compress' in group[dims[0]].ncattrs()
+
+
+def writeGathered(group, frame, encoding, unlimitedDims):
+	"""
+	Writes the glider record with every sensor stored only at its own valid samples, following the CF
+	convention for compression by gathering: the sensors sampled at the same rows share a dimension
+	'x_obs' (named after the first of them, x), a list variable 'x_obs(x_obs)' with those rows of
+	'time' (attribute compress = "time") and their values 'x(x_obs)', 'y(x_obs)', ...  Time and integer
+	columns (never missing) are stored as usual.
+
+	Args:
+	group (netCDF4.Group): target group.
+	frame (pd.DataFrame): the glider record, with a 'time' column.
+	encoding (dict): createVariable options (compression, chunk sizes and 'dtype') per column name.
+	unlimitedDims (list): names of the unlimited dimensions ('time' in trajectory files, where the
+		'x_obs' dimensions are unlimited too so new rows can be appended).
+	"""
+	requireDimension(group, 'time', len(frame), unlimitedDims)
+	timeVar = group.createVariable('time', frame['time'].dtype, ('time',), fill_value=np.nan)
+	timeVar[:] = frame['time'].to_numpy()
+	unlimited = 'time' in unlimitedDims
+	#
+	def options(name, n):
+		opts = dict(encoding.get(name, {}))
+		opts.pop('dtype', None)
+		if not unlimited:
+			opts.pop('chunksizes', None)
+			if n == 0:
+				opts = {}  # empty variables can't be chunked
+		return opts
+	#
+	samples = {}
+	for name in frame.columns:
+		if name != 'time' and frame[name].dtype.kind == 'f':
+			valid = ~np.isnan(frame[name].to_numpy())
+			samples.setdefault(np.packbits(valid).tobytes(), (valid, []))[1].append(name)
+	listNames = {}
+	for valid, names in samples.values():
+		rows = np.flatnonzero(valid)
+		listName = names[0] + '_obs'
+		group.createDimension(listName, None if unlimited else len(rows))
+		listVar = group.createVariable(listName, np.int32, (listName,), **options(names[0], len(rows)))
+		listVar.setncattr('compress', 'time')
+		listVar[:] = rows
+		listNames.update(dict.fromkeys(names, (listName, rows)))
+	#
+	for name in frame.columns:
+		if name == 'time':
+			continue
+		values = frame[name].to_numpy()
+		dtype = encoding.get(name, {}).get('dtype', values.dtype)
+		if name not in listNames:
+			group.createVariable(name, dtype, ('time',), **options(name, len(values)))[:] = values
+			continue
+		listName, rows = listNames[name]
+		var = group.createVariable(name, dtype, (listName,), fill_value=np.nan, **options(name, len(rows)))
+		var[:] = values[rows]
+
+
+def gliderRecordValues(group, name, rows=slice(None)):
+	"""
+	Dense values of one variable of the glider record (stored dense or gathered) for a range of rows.
+	"""
+	var = group[name]
+	if not isGathered(group, name):
+		return np.ma.filled(var[rows].astype(float), np.nan)
+	start, stop, step = rows.indices(len(group['time']))
+	index = group[var.dimensions[0]][:]
+	selected = (index >= start) & (index < stop)
+	values = np.full(stop - start, np.nan, dtype=np.result_type(var.dtype, np.float32))
+	values[index[selected] - start] = np.ma.filled(var[:][selected], np.nan)
+	return values[::step]
+
+
+def readGliderRecord(ncFilename, variables=None):
+	"""
+	Reads the glider record group of a profile or trajectory file into a dense frame, whether it is
+	stored dense or gathered.
+
+	Args:
+	ncFilename (str): netCDF file.
+	variables (list): variables to read (default: all of them).
+
+	Returns:
+	pd.DataFrame with a 'time' column and one column per variable.
+	"""
+	with netCDF4.Dataset(ncFilename, 'r') as nc:
+		group = nc.groups['glider_record']
+		if variables is None:
+			variables = [name for name, var in group.variables.items() if name != 'time' and 'compress' not in var.ncattrs()]
+		frame = {'time': np.ma.filled(group['time'][:], np.nan)}
+		for name in variables:
+			frame[name] = gliderRecordValues(group, name)
+	return pd.DataFrame(frame)
+
+
+def saveNetcdf(data, gliderData, sourceInfo, settings=None):
+	"""
+	Writes the data and the glider record (group 'glider_record') of a profile or trajectory file
+	through one file handle.
+
+	Args:
+	data (pd.DataFrame): processed data.
+	gliderData (pd.DataFrame): raw glider variables.
+	sourceInfo (dict): Information about the Dataset and processing mode
+	settings (dict): output settings (default: from the output settings file, see outputSettings).
+	"""
 	def checkVariables(dataset):
 		# time_dim_size = dataset.dims['time']
 		dataVars = {varName: varData for varName, varData in dataset.variables.items() if varName != 'time'}
@@ -153,14 +514,52 @@ def saveNetcdf(data, gliderData, sourceInfo):
 						 for varName, varData in dataVars.items()}
 		return xr.Dataset(reshapedVars, coords=dataset.coords)
 	#
-	comp = dict(zlib=True, complevel=5)
-	if not data.empty:
-		data = data.set_index('time').to_xarray()
-		data = dataAttributes(data, sourceInfo)
-		encoding = {var: comp for var in data.data_vars}
-		data.to_netcdf(sourceInfo['ncFilename'], mode='w', encoding=encoding)
-	if not gliderData.empty:
-		gliderData = gliderData.set_index('time').to_xarray()
-		gliderData = checkVariables(gliderData)
-		encoding = {var: comp for var in gliderData.data_vars}
-		gliderData.to_netcdf(sourceInfo['ncFilename'], group="glider_record", mode="a", encoding=encoding)
+	def compression(dataset, name):
+		# Compress the data variables; trajectory files grow along an unlimited time dimension,
+		# which needs explicit chunks
+		var = dataset[name]
+		encoding = dict(zlib=settings['complevel'] > 0, complevel=settings['complevel'], shuffle=settings['shuffle'])
+		if var.dims == ('time',):
+			if settings['chunk']:
+				encoding['chunksizes'] = (min(settings['chunk'], max(var.size, 1)) if not unlimitedDims else settings['chunk'],)
+			elif unlimitedDims:
+				encoding['chunksizes'] = (trajectoryChunk,)
+		return encoding
+	#
+	def setDtypes(dataset):
+		# stored types are applied by the CF encoding (fill values for integer types)
+		for name, dtype in (settings['dtypes'] or {}).items():
+			if name in dataset.variables:
+				dataset[name].encoding['dtype'] = np.dtype(dtype)
+		return dataset
+	#
+	if settings is None:
+		settings = outputSettings(sourceInfo)
+	trajectoryChunk = 16384
+	unlimitedDims = ['time'] if sourceInfo['dataType'] == 'trajectory' else []
+	if data.empty and gliderData.empty:
+		return
+	mode = 'a' if data.empty and os.path.exists(sourceInfo['ncFilename']) else 'w'
+	with netCDF4.Dataset(sourceInfo['ncFilename'], mode) as nc:
+		if not data.empty:
+			data = data.set_index('time').to_xarray()
+			data = setDtypes(dataAttributes(data, sourceInfo))
+			writeGroup(nc, data, {var: compression(data, var) for var in data.data_vars}, unlimitedDims)
+		if not gliderData.empty and settings.get('gliderRecord', 'dense') == 'gathered':
+			encoding = {}
+			for var in gliderData.columns:
+				encoding[var] = dict(zlib=settings['complevel'] > 0, complevel=settings['complevel'], shuffle=settings['shuffle'],
+									 chunksizes=(settings['chunk'] or trajectoryChunk,))
+				if var in (settings['dtypes'] or {}):
+					encoding[var]['dtype'] = np.dtype(settings['dtypes'][var])
+			for var, fill in stateFills(gliderData).items():
+				encoding[var]['fill_value'] = fill
+			writeGathered(nc.createGroup('glider_record'), gliderData, encoding, unlimitedDims)
+		elif not gliderData.empty:
+			fills = stateFills(gliderData)
+			gliderData = gliderData.set_index('time').to_xarray()
+			gliderData = setDtypes(checkVariables(gliderData))
+			for var, fill in fills.items():
+				gliderData[var].encoding['_FillValue'] = fill
+			writeGroup(nc.createGroup('glider_record'), gliderData,
+					   {var: compression(gliderData, var) for var in gliderData.data_vars}, unlimitedDims)
@@ -0,0 +1,139 @@
+import os
+import re
+import yaml
+import numpy as np
+
+# Types of the glider record columns, next to the IOOS encoder
+dtypePolicyFile = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'attributes', 'dtype_policy.yml')
+_dtypePolicies = {}
+
+
+def loadDtypePolicy(filename=None):
+	"""
+	Reads the type policy of the glider record (see attributes/dtype_policy.yml); the file is read
+	once per process and again only if it changes.
+
+	Returns:
+		dict with the ordered 'rules' (pattern, excluded names, dtype, fill value) and the 'sensors' type.
+	"""
+	if filename is None:
+		filename = dtypePolicyFile
+	mtime = os.path.getmtime(filename)
+	if filename not in _dtypePolicies or _dtypePolicies[filename][0] != mtime:
+		with open(filename, 'r') as f:
+			table = yaml.safe_load(f)
+		def regex(patterns):
+			return re.compile('|'.join('(?:%s)' % p for p in patterns)) if patterns else None
+		rules = []
+		for kind in ['states', 'double']:
+			entry = table.get(kind) or {}
+			if entry.get('patterns'):
+				rules.append((regex(entry['patterns']), regex(entry.get('exclude')), np.dtype(entry['dtype']), entry.get('fill')))
+		policy = {'rules': rules, 'sensors': np.dtype(table['sensors']['dtype']), 'columns': {}}
+		_dtypePolicies[filename] = (mtime, policy)
+	return _dtypePolicies[filename][1]
+
+
+def columnType(name, filename=None):
+	"""
+	Type and fill value (None for floating point types) of a glider record column.
+	"""
+	policy = loadDtypePolicy(filename)
+	if name not in policy['columns']:
+		found = (policy['sensors'], None)
+		for pattern, exclude, dtype, fill in policy['rules']:
+			if pattern.search(name) and not (exclude and exclude.search(name)):
+				found = (dtype, fill if dtype.kind in 'iu' else None)
+				break
+		policy['columns'][name] = found
+	return policy['columns'][name]
+
+
+def compactFrame(frame, filename=None):
+	"""
+	Converts the columns of a glider record to the types of the policy, in place: times and positions
+	stay double, discrete states become small integers (nan -> fill value) and the other sensors single
+	precision where no value changes (8-byte sensors stay double).  Integer columns that aren't states
+	(e.g. the trajectory 'index') are kept.
+
+	Args:
+		frame (pd.DataFrame): glider record.
+		filename (str): policy file (default: attributes/dtype_policy.yml).
+
+	Returns:
+		the frame.
+	"""
+	for col in frame.columns:
+		values = frame[col].to_numpy()
+		dtype, fill = columnType(col, filename)
+		if values.dtype == dtype or values.dtype.kind not in 'fiu':
+			continue
+		if fill is None:
+			if values.dtype.kind == 'f':
+				frame[col] = narrowFloats(values, dtype)
+			continue
+		valid = ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(len(values), dtype=bool)
+		info = np.iinfo(dtype)
+		states = values[valid]
+		if np.all((states == np.round(states)) & (states >= info.min) & (states <= info.max) & (states != fill)):
+			frame[col] = np.where(valid, values, fill).astype(dtype)
+		else:
+			# the fill value of the segments it was an integer in is missing too
+			print("Warning: %s doesn't fit the %s state type.  Kept as %s." % (col, dtype, loadDtypePolicy(filename)['sensors']))
+			frame[col] = narrowFloats(np.where(values == fill, np.nan, values).astype(float), loadDtypePolicy(filename)['sensors'])
+	return frame
+
+
+def narrowFloats(values, dtype):
+	"""
+	Floating point values in type dtype, if that is wider or loses nothing; otherwise in double precision.
+	"""
+	if np.dtype(dtype).itemsize >= values.dtype.itemsize:
+		return values.astype(dtype)
+	narrow = values.astype(dtype)
+	return narrow if np.array_equal(narrow, values, equal_nan=True) else values.astype(np.float64)
+
+
+def floatColumn(frame, name, filename=None):
+	"""
+	A glider record column as doubles, with the fill value of an integer state replaced by nan.
+	"""
+	values = frame[name].astype(float)
+	fill = columnType(name, filename)[1]
+	if fill is not None:
+		values = values.mask(values == fill)
+	return values
+
+
+def stateFills(frame, filename=None):
+	"""
+	Fill values of the integer state columns of a glider record, for the netCDF encoding.
+	"""
+	fills = {}
+	for col in frame.columns:
+		fill = columnType(col, filename)[1]
+		if fill is not None and frame[col].dtype.kind in 'iu':
+			fills[col] = fill
+	return fills
+
+
+def singleWhereExact(frame, keep=('time',)):
+	"""
+	Converts the double columns of a decoded frame to single precision where no value changes (the
+	glider stores most sensors as 4-byte floats), in place.
+
+	Args:
+		frame (pd.DataFrame): decoded *.?bd data.
+		keep (tuple): columns left as they are.
+
+	Returns:
+		the frame.
+	"""
+	for col in frame.columns:
+		values = frame[col].to_numpy()
+		if col in keep or values.dtype != np.float64:
+			continue
+		single = values.astype(np.float32)
+		if np.array_equal(single, values, equal_nan=True):
+			frame[col] = single
+	return frame
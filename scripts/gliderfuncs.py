@@ -1,12 +1,18 @@
 import gsw
+import warnings
 import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
 
 def interpolateNANs(x, time: np.ndarray = None, tgap: int = None):
 	"""
 	Fills not a number (nan's) in arrays
 
+	Every nan (except the first and last sample) is linearly interpolated, by sample index, between the
+	valid samples around it.  If tgap is given, nan's whose time step to the previous or next sample is
+	larger than tgap seconds (whole seconds) are left as they are.
+
 	Returns:
 		Array with nan's filled.
 	"""
@@ -17,31 +23,39 @@ def interpolateNANs(x, time: np.ndarray = None, tgap: int = None):
 	if not np.any(notNAN):
 		return x  # Return the input array if it contains only NaN values
 
-	if time is not None:
-		if not isinstance(time[0], np.datetime64):
-			time = np.array(time, dtype='datetime64[s]')
-
-	NANindices = np.flatnonzero(np.isnan(x))
-
-	for idx in NANindices:
-		if idx == 0 or idx == len(x) - 1:
-			continue
+	NANindices = np.flatnonzero(~notNAN)
+	NANindices = NANindices[(NANindices > 0) & (NANindices < len(x) - 1)]
+	if NANindices.size == 0:
+		return x
 
+	if tgap is not None:
 		if time is not None:
-			leftTimeDiff = abs((time[idx] - time[idx - 1]).astype('timedelta64[s]').astype(float))
-			rightTimeDiff = abs((time[idx + 1] - time[idx]).astype('timedelta64[s]').astype(float))
+			timeStep = np.abs(timeSteps(time))
 		else:
-			leftTimeDiff = 1
-			rightTimeDiff = 1
+			timeStep = np.ones(len(x) - 1)
+		# nan time steps (missing times) never count as small enough
+		inGap = ~(timeStep[NANindices - 1] <= tgap) | ~(timeStep[NANindices] <= tgap)
+		NANindices = NANindices[~inGap]
 
-		if tgap is not None and (leftTimeDiff > tgap or rightTimeDiff > tgap):
-			continue
-
-		x[idx] = np.interp(idx, np.flatnonzero(notNAN), x[notNAN])
+	x[NANindices] = np.interp(NANindices, np.flatnonzero(notNAN), x[notNAN])
 
 	return x
 
 
+def timeSteps(time):
+	"""
+	Time steps in whole seconds between consecutive samples (nan where a time is missing).
+
+	Args:
+		time: Unix timestamps (truncated to whole seconds) or datetime64 values.
+	"""
+	time = np.asarray(time)
+	if np.issubdtype(time.dtype, np.datetime64):
+		steps = np.diff(time).astype('timedelta64[s]')
+		return np.where(np.isnat(steps), np.nan, steps.astype(float))
+	return np.diff(np.trunc(time.astype(float)))
+
+
 def p2depth(p: np.ndarray, time: np.ndarray = None, interpolate: bool = True, tgap: int = 20):
 	"""
 	Calculate the depth in meters from the sea water pressure in dbar.
@@ -163,13 +177,6 @@ def deriveO2(O2fresh: np.ndarray, t: np.ndarray, SP: np.ndarray, time: np.ndarra
 		ValueError: If O2fresh is not a numpy array.
 	
 	"""
-	# define constants
-	a1 = -0.00624097
-	a2 = 0.00693498
-	a3 = 0.00690358
-	a4 = 0.00429155
-	a5 = 3.11680e-7
-	
 	# Convert input arrays to ndarrays if they are not already
 	t = np.asarray(t)
 	SP = np.asarray(SP)
@@ -186,13 +193,164 @@ def deriveO2(O2fresh: np.ndarray, t: np.ndarray, SP: np.ndarray, time: np.ndarra
 			else:
 				O2fresh = interpolateNANs(O2fresh, tgap=tgap)
 		
-		sca_T = np.log((298.15 - t) / (273.15 + t))
-		O2sal = O2fresh * np.exp(SP * (a1 - a2 * sca_T - a3 * sca_T**2 - a4 * sca_T**3) - a5 * SP**2)
+		O2sal = compensateO2(O2fresh, t, SP)
 	else:
 		O2sal = np.full_like(O2fresh, np.nan)
 
 	return O2sal
 
+def compensateO2(O2fresh, t, SP):
+	"""
+	Oxygen compensated from "fresh" (salinity 0) to the measured salinity, from the scaled temperature.
+	"""
+	# define constants
+	a1 = -0.00624097
+	a2 = 0.00693498
+	a3 = 0.00690358
+	a4 = 0.00429155
+	a5 = 3.11680e-7
+	
+	sca_T = np.log((298.15 - t) / (273.15 + t))
+	return O2fresh * np.exp(SP * (a1 - a2 * sca_T - a3 * sca_T**2 - a4 * sca_T**3) - a5 * SP**2)
+
+def deriveCTDO2(c, t, p, lon, lat, O2fresh=None, time=None, positions='mean', tgap=20, chunkSize=16384, workers=1):
+	"""
+	Derives the CTD products (see deriveCTD) and the salinity compensated oxygen (see deriveO2) in one pass.
+
+	Only the rows where conductivity, temperature and pressure are all valid (often a small part of the
+	merged flight and science record) are computed, chunk by chunk: the rows of a chunk are gathered into
+	contiguous arrays, every product is computed while they are in cache and the results are scattered back
+	to their rows (gsw releases the GIL, so chunks run in parallel threads).  The other rows are nan.
+
+	Args:
+		c, t, p (np.ndarray): conductivity (S/m), temperature (degrees Celsius) and pressure (dbar).
+		lon, lat (np.ndarray): longitude and latitude (degrees).
+		O2fresh (np.ndarray): oxygen at salinity 0 (micro-mol / L), interpolated over gaps shorter than tgap (None: no oxygen).
+		time (np.ndarray): Unix timestamps (for the oxygen and position interpolation).
+		positions (str): 'mean' uses the mean position of the segment for the absolute salinity; 'interpolate'
+			the positions interpolated (in time) to every sample.
+		tgap (int): largest gap in the oxygen samples interpolated over (seconds).
+		chunkSize (int): rows per chunk.
+		workers (int): number of threads.
+
+	Returns:
+		practical salinity, absolute salinity, conservative temperature, density, oxygen concentration (None without O2fresh)
+	"""
+	c, t, p = (np.asarray(x, dtype=float) for x in (c, t, p))
+	lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+	if not (c.shape == t.shape == p.shape):
+		raise ValueError("All input arrays must have the same shape.")
+	if time is not None:
+		time = np.asarray(time)
+	n = len(c)
+	rows = np.flatnonzero(~np.isnan(c) & ~np.isnan(t) & ~np.isnan(p))
+	#
+	if positions == 'interpolate':
+		stamp = np.asarray(time, dtype=float) if time is not None else np.arange(n, dtype=float)
+		def interpolated(x):
+			valid = np.flatnonzero(~np.isnan(x) & ~np.isnan(stamp))
+			return np.interp(stamp, stamp[valid], x[valid]) if len(valid) else np.full(n, np.nan)
+		lon, lat = interpolated(lon), interpolated(lat)
+	else:
+		with warnings.catch_warnings():
+			warnings.simplefilter("ignore", category=RuntimeWarning)  # no valid position
+			lon, lat = np.full(1, np.nanmean(lon)), np.full(1, np.nanmean(lat))
+	if O2fresh is not None:
+		O2fresh = np.asarray(O2fresh, dtype=float)
+		hasO2 = np.any(~np.isnan(O2fresh))
+		if hasO2:
+			O2fresh = interpolateNANs(O2fresh, time, tgap=tgap)
+	#
+	products = [np.full(n, np.nan) for k in range(4 if O2fresh is None else 5)]
+	def derive(start):
+		# gather the chunk's rows, compute all products in cache and scatter them back
+		index = rows[start:start + chunkSize]
+		ci, ti, pi = c[index], t[index], p[index]
+		loni, lati = (lon[index], lat[index]) if len(lon) == n else (lon[0], lat[0])
+		SP = gsw.conversions.SP_from_C(ci*10, ti, pi)
+		SA = gsw.SA_from_SP(SP, pi, loni, lati)
+		CT = gsw.CT_from_t(SA, ti, pi)
+		products[0][index], products[1][index], products[2][index] = SP, SA, CT
+		products[3][index] = gsw.rho(SA, CT, pi)
+		if O2fresh is not None and hasO2:
+			products[4][index] = compensateO2(O2fresh[index], ti, SP)
+	starts = range(0, len(rows), chunkSize)
+	if workers > 1 and len(starts) > 1:
+		with ThreadPoolExecutor(min(workers, len(starts))) as pool:
+			list(pool.map(derive, starts))
+	else:
+		for start in starts:
+			derive(start)
+	if O2fresh is None:
+		products.append(None)
+	return products
+
+def findCasts(stamp, depth, validIndex, optionsList):
+	"""
+	Splits a depth sequence into monotonic segments at its depth peaks and joins the cast segments into casts.
+
+	Args:
+		stamp (np.ndarray): A 1D array of timestamps (seconds).
+		depth (np.ndarray): A 1D array of depths.
+		validIndex (np.ndarray): rows where both are valid.
+		optionsList (dict): length, period, inversion, interrupt, stall and shake (see findProfiles).
+
+	Returns:
+		sdy (np.ndarray): vertical direction between consecutive valid rows.
+		castHeadIndex, castTailIndex (np.ndarray): first and last row of every cast.
+		castValid (np.ndarray): casts long enough to be profiles.
+		castHeadEnd (np.ndarray): last row of the first segment of every cast.
+	"""
+	sdy = np.sign(np.diff(depth[validIndex], n=1, axis=0))
+	depthPeak = np.ones(np.size(validIndex), dtype=bool)
+	depthPeak[1:len(depthPeak) - 1,] = np.diff(sdy, n=1, axis=0) != 0
+	depthPeakIndex = validIndex[depthPeak]
+	sgmtFrst = stamp[depthPeakIndex[0:len(depthPeakIndex) - 1,]]
+	sgmtLast = stamp[depthPeakIndex[1:,]]
+	sgmtStrt = depth[depthPeakIndex[0:len(depthPeakIndex) - 1,]]
+	sgmtFnsh = depth[depthPeakIndex[1:,]]
+	sgmtSinc = sgmtLast - sgmtFrst
+	sgmtVinc = sgmtFnsh - sgmtStrt
+	sgmtVdir = np.sign(sgmtVinc)
+
+	castSgmtValid = np.logical_not(np.logical_or(np.abs(sgmtVinc) <= optionsList["stall"], sgmtSinc <= optionsList["shake"]))
+	castSgmtIndex = np.argwhere(castSgmtValid).flatten()
+	castSgmtLapse = sgmtFrst[castSgmtIndex[1:]] - sgmtLast[castSgmtIndex[0:len(castSgmtIndex) - 1]]
+	castSgmtSpace = -np.abs(sgmtVdir[castSgmtIndex[0:len(castSgmtIndex) - 1]] * (sgmtStrt[castSgmtIndex[1:]] - sgmtFnsh[castSgmtIndex[0:len(castSgmtIndex) - 1]]))
+	castSgmtDirch = np.diff(sgmtVdir[castSgmtIndex], n=1, axis=0)
+	castSgmtBound = np.logical_not((castSgmtDirch[:,] == 0) & (castSgmtLapse[:,] <= optionsList["interrupt"]) & (castSgmtSpace <= optionsList["inversion"]))
+	castSgmtHeadValid = np.ones(np.size(castSgmtIndex), dtype=bool)
+	castSgmtTailValid = np.ones(np.size(castSgmtIndex), dtype=bool)
+	castSgmtHeadValid[1:,] = castSgmtBound
+	castSgmtTailValid[0:len(castSgmtTailValid) - 1,] = castSgmtBound
+
+	castHeadIndex = depthPeakIndex[castSgmtIndex[castSgmtHeadValid]]
+	castTailIndex = depthPeakIndex[castSgmtIndex[castSgmtTailValid] + 1]
+	castHeadEnd = depthPeakIndex[castSgmtIndex[castSgmtHeadValid] + 1]
+	castLength = np.abs(depth[castTailIndex] - depth[castHeadIndex])
+	castPeriod = stamp[castTailIndex] - stamp[castHeadIndex]
+	castValid = np.logical_not(np.logical_or(castLength <= optionsList["length"], castPeriod <= optionsList["period"]))
+	return sdy, castHeadIndex, castTailIndex, castValid, castHeadEnd
+
+def profileMarks(size, castHeadIndex, castTailIndex, castValid):
+	"""
+	Profile index increments (0.5 after the head and at the tail of every valid cast) of a sequence of 'size' rows.
+	"""
+	castHead = np.zeros(size)
+	castTail = np.zeros(size)
+	castHead[castHeadIndex[castValid] + 1] = 0.5
+	castTail[castTailIndex[castValid]] = 0.5
+	return castHead + castTail
+
+def profileDirections(size, validIndex, sdy):
+	"""
+	Vertical direction of every row: the direction towards the next valid row (nan before the first and from the last valid row).
+	"""
+	profileDirection = np.full(size, np.nan)
+	if len(validIndex) > 1:
+		profileDirection[validIndex[0]:validIndex[-1]] = np.repeat(sdy, np.diff(validIndex))
+	return profileDirection
+
 def findProfiles(stamp: np.ndarray,depth: np.ndarray,**kwargs):
 	"""
 	Identify individual profiles and compute vertical direction from depth sequence.
@@ -230,55 +388,132 @@ def findProfiles(stamp: np.ndarray,depth: np.ndarray,**kwargs):
 	validIndex = np.argwhere(np.logical_not(np.isnan(depth)) & np.logical_not(np.isnan(stamp))).flatten()
 	validIndex = validIndex.astype(int)
 	
-	sdy = np.sign(np.diff(depth[validIndex], n=1, axis=0))
-	depthPeak = np.ones(np.size(validIndex), dtype=bool)
-	depthPeak[1:len(depthPeak) - 1,] = np.diff(sdy, n=1, axis=0) != 0
-	depthPeakIndex = validIndex[depthPeak]
-	sgmtFrst = stamp[depthPeakIndex[0:len(depthPeakIndex) - 1,]]
-	sgmtLast = stamp[depthPeakIndex[1:,]]
-	sgmtStrt = depth[depthPeakIndex[0:len(depthPeakIndex) - 1,]]
-	sgmtFnsh = depth[depthPeakIndex[1:,]]
-	sgmtSinc = sgmtLast - sgmtFrst
-	sgmtVinc = sgmtFnsh - sgmtStrt
-	sgmtVdir = np.sign(sgmtVinc)
+	sdy, castHeadIndex, castTailIndex, castValid, castHeadEnd = findCasts(stamp, depth, validIndex, optionsList)
+	profileIndex = 0.5 + np.cumsum(profileMarks(len(depth), castHeadIndex, castTailIndex, castValid))
+	profileDirection = profileDirections(len(depth), validIndex, sdy)
 
-	castSgmtValid = np.logical_not(np.logical_or(np.abs(sgmtVinc) <= optionsList["stall"], sgmtSinc <= optionsList["shake"]))
-	castSgmtIndex = np.argwhere(castSgmtValid).flatten()
-	castSgmtLapse = sgmtFrst[castSgmtIndex[1:]] - sgmtLast[castSgmtIndex[0:len(castSgmtIndex) - 1]]
-	castSgmtSpace = -np.abs(sgmtVdir[castSgmtIndex[0:len(castSgmtIndex) - 1]] * (sgmtStrt[castSgmtIndex[1:]] - sgmtFnsh[castSgmtIndex[0:len(castSgmtIndex) - 1]]))
-	castSgmtDirch = np.diff(sgmtVdir[castSgmtIndex], n=1, axis=0)
-	castSgmtBound = np.logical_not((castSgmtDirch[:,] == 0) & (castSgmtLapse[:,] <= optionsList["interrupt"]) & (castSgmtSpace <= optionsList["inversion"]))
-	castSgmtHeadValid = np.ones(np.size(castSgmtIndex), dtype=bool)
-	castSgmtTailValid = np.ones(np.size(castSgmtIndex), dtype=bool)
-	castSgmtHeadValid[1:,] = castSgmtBound
-	castSgmtTailValid[0:len(castSgmtTailValid) - 1,] = castSgmtBound
+	return profileIndex, profileDirection
 
-	castHeadIndex = depthPeakIndex[castSgmtIndex[castSgmtHeadValid]]
-	castTailIndex = depthPeakIndex[castSgmtIndex[castSgmtTailValid] + 1]
-	castLength = np.abs(depth[castTailIndex] - depth[castHeadIndex])
-	castPeriod = stamp[castTailIndex] - stamp[castHeadIndex]
-	castValid = np.logical_not(np.logical_or(castLength <= optionsList["length"], castPeriod <= optionsList["period"]))
-	castHead = np.zeros(np.size(depth))
-	castTail = np.zeros(np.size(depth))
-	castHead[castHeadIndex[castValid] + 1] = 0.5
-	castTail[castTailIndex[castValid]] = 0.5
+def findProfilesChunk(stamp, depth, state=None, final=False, **kwargs):
+	"""
+	Resumable findProfiles: identifies the profiles of a record given in consecutive chunks (in time order).
 
-	profileIndex = 0.5 + np.cumsum(castHead + castTail)
-	profileDirection = np.empty((len(depth,)))
-	profileDirection[:] = np.nan
+	The rows from the head of the last cast that may still be extended by the next chunk are kept
+	pending in the state and scanned again with it; the rows before are final.  Every row is returned
+	exactly once, and the concatenated results are those of findProfiles over the whole record.
 
-	for i in range(len(validIndex) - 1):
-		iStart = validIndex[i]
-		iEnd = validIndex[i + 1]
-		profileDirection[iStart:iEnd] = sdy[i]
+	Args:
+		stamp (np.ndarray): timestamps of the chunk.
+		depth (np.ndarray): depths of the chunk.
+		state (dict): state returned by the previous call (None for the first chunk).
+		final (bool): last chunk of the record; all pending rows are returned.
+		**kwargs (optional): options of findProfiles (used from the first call on).
 
-	return profileIndex, profileDirection
+	Returns:
+		profile_index (np.ndarray): profile indices of the rows that became final.
+		profile_direction (np.ndarray): vertical directions of the same rows.
+		state (dict): pending rows ('stamp', 'depth'), profile index 'offset' and 'options' for the next call.
+	"""
+	stamp = np.asarray(stamp).flatten()
+	depth = np.asarray(depth, dtype=float).flatten()
+	if state is None:
+		optionsList = { "length": 0, "period": 0, "inversion": 0, "interrupt": 0, "stall": 0, "shake": 0}
+		optionsList.update(kwargs)
+		state = {'stamp': np.empty(0), 'depth': np.empty(0), 'offset': 0.0, 'options': optionsList,
+				 'epoch': stamp[0] if len(stamp) and np.issubdtype(stamp.dtype, np.datetime64) else None}
+	if state['epoch'] is not None:
+		# elapsed seconds since the start of the record, as in findProfiles
+		stamp = (stamp - state['epoch']).astype('timedelta64[s]').astype(float)
+	stamp = np.concatenate([state['stamp'], stamp.astype(float)])
+	depth = np.concatenate([state['depth'], depth])
+	#
+	validIndex = np.flatnonzero(np.logical_not(np.isnan(depth)) & np.logical_not(np.isnan(stamp)))
+	sdy, castHeadIndex, castTailIndex, castValid, castHeadEnd = findCasts(stamp, depth, validIndex, state['options'])
+	# Resume at the head of the last cast whose first segment is complete: the casts before it can't change
+	cut = len(depth)
+	if not final:
+		complete = castHeadIndex[castHeadEnd < (validIndex[-1] if len(validIndex) else 0)]
+		cut = int(complete[-1]) if len(complete) else 0
+	profileIndex = state['offset'] + 0.5 + np.cumsum(profileMarks(len(depth), castHeadIndex, castTailIndex, castValid))
+	profileDirection = profileDirections(len(depth), validIndex, sdy)
+	#
+	state = dict(state, stamp=stamp[cut:], depth=depth[cut:],
+				 offset=profileIndex[cut] - 0.5 if cut < len(depth) else state['offset'])
+	return profileIndex[:cut], profileDirection[:cut], state
+
+def resumeProfiles(profileIndex, stamp, depth, **kwargs):
+	"""
+	State of findProfilesChunk after a record that was already scanned, pending from the head of its last
+	profile (the profiles before it can't change when the record is extended).
+
+	Args:
+		profileIndex (np.ndarray): profile indices of the record.
+		stamp, depth (array-like): timestamps and depths of (at least) the rows of the record, e.g. netCDF variables; only
+			the pending rows are read.
+		**kwargs (optional): options of findProfiles.
+
+	Returns:
+		start (int): first pending row, returned again by the next findProfilesChunk call.
+		state (dict): state for findProfilesChunk.
+	"""
+	profileIndex = np.ma.filled(profileIndex, np.nan).astype(float)
+	profiles = np.flatnonzero(profileIndex == np.floor(profileIndex))
+	start = 0
+	if len(profiles):
+		# the head of a cast is the row before its first row
+		start = max(int(np.argmax(profileIndex == profileIndex[profiles[-1]])) - 1, 0)
+	optionsList = { "length": 0, "period": 0, "inversion": 0, "interrupt": 0, "stall": 0, "shake": 0}
+	optionsList.update(kwargs)
+	end = len(profileIndex)
+	state = {'stamp': np.ma.filled(stamp[start:end], np.nan).astype(float),
+			 'depth': np.ma.filled(depth[start:end], np.nan).astype(float),
+			 'offset': profileIndex[start] - 0.5 if start < len(profileIndex) else 0.0, 'options': optionsList, 'epoch': None}
+	return start, state
+
+def profileMeans(profileIndex, *variables):
+	"""
+	Mean of variables over every profile, computed for all profiles in one pass.
+
+	Rows with an integer profile index belong to that profile (the half-integer indices between
+	profiles don't).  Each profile gets an integer code and the sums and counts of the valid samples of
+	every profile are accumulated with np.bincount, then broadcast back to the rows of the profile.
+
+	Args:
+		profileIndex (np.ndarray): profile index of every row (see findProfiles).
+		*variables (np.ndarray): variables to average (nan's are skipped).
+
+	Returns:
+		list of np.ndarray, the profile mean of each variable on every row of the profile (nan elsewhere).
+	"""
+	profileIndex = np.asarray(profileIndex, dtype=float)
+	inProfile = profileIndex == np.floor(profileIndex)
+	profiles, code = np.unique(profileIndex[inProfile], return_inverse=True)
+	means = []
+	for values in variables:
+		values = np.asarray(values, dtype=float)[inProfile]
+		valid = ~np.isnan(values)
+		# sums relative to the first valid value keep the precision of large values (e.g. Unix times)
+		offset = values[valid][0] if valid.any() else 0.0
+		sums = np.bincount(code, weights=np.where(valid, values - offset, 0), minlength=len(profiles))
+		counts = np.bincount(code, weights=valid, minlength=len(profiles))
+		mean = np.full(len(profileIndex), np.nan)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			mean[inProfile] = (offset + sums / counts)[code]
+		means.append(mean)
+	return means
 
 def correctDeadReckoning(gliderLon, gliderLat, gliderTimestamp, diveState, gpsLon, gpsLat):
 	"""
 	Corrects glider dead reckoned locations when underwater
 	using the gps and drift at surface state (approximate currents)
 
+	Every dive ends when the glider surfaces (diveState 1 -> 2) and starts when it left the surface
+	(4 -> 1) for the first time after the previous surfacing, so that 1 -> 4 -> 1 excursions without
+	a fix belong to the dive.  Its drift velocity is the offset between the first position after the
+	surface fix (2 -> 3 or 2 -> 4) and the last dead reckoned one, over the duration of the dive.
+	All dives are found and corrected at once (the valid positions around each state change are
+	found with np.searchsorted); dives without a start, a fix or valid positions are left uncorrected.
+
 	Parameters:
 		gliderLon (pd.Series): glider longitude
 		gliderLat (pd.Series): glider latitude
@@ -293,86 +528,90 @@ def correctDeadReckoning(gliderLon, gliderLat, gliderTimestamp, diveState, gpsLo
 	"""
 	if not (isinstance(gliderLon, pd.Series) and isinstance(gliderLat, pd.Series) and isinstance(gliderTimestamp, pd.Series) and isinstance(diveState, pd.Series) and isinstance(gpsLon, pd.Series) and isinstance(gpsLat, pd.Series)):
 		raise ValueError("lon,lat inputs must be pandas series.")
+	lon = gliderLon.to_numpy(dtype=float)
+	lat = gliderLat.to_numpy(dtype=float)
+	stamp = gliderTimestamp.to_numpy(dtype=float)
 	#
-	# Fill NaN values with previous value
-	diveState = diveState.ffill()
-	#
-	# Find the start of each dive
-	diveStarts = np.argwhere(np.diff(diveState**2) != 0).flatten()
-	diveStarts = diveStarts[np.argwhere(np.diff(diveState[diveStarts]**2, n=2, axis=0) == 18).flatten()]
-	# diveStarts = np.argwhere(np.diff(diveState) < 0).flatten()
+	# Dive state changes (fill NaN values with previous value); row i is the last row before the change
+	state = diveState.ffill().to_numpy(dtype=float)
+	before, after = state[:-1], state[1:]
+	surfacings = np.flatnonzero((before == 1) & (after == 2))
+	departures = np.flatnonzero((before == 4) & (after == 1))
+	fixes = np.flatnonzero((before == 2) & ((after == 3) | (after == 4))) + 1
 	#
-	# Remove diveStarts with NaN values
-	for ki in range(len(diveStarts)):
-		while gliderLon[diveStarts[ki]] != gliderLon[diveStarts[ki]]:
-			diveStarts[ki] = diveStarts[ki] + 1
+	# Start (first departure after the previous surfacing) and end (first fix before the next surfacing) of each dive
+	previous = np.concatenate(([-1], surfacings))[:-1]
+	following = np.concatenate((surfacings, [len(state)]))[1:]
+	k = np.searchsorted(departures, previous, side='right')
+	valid = k < len(departures)
+	diveStarts = departures[np.minimum(k, len(departures) - 1)] if len(departures) else surfacings
+	valid &= diveStarts < surfacings
+	k = np.searchsorted(fixes, surfacings, side='right')
+	valid &= k < len(fixes)
+	diveEnds = fixes[np.minimum(k, len(fixes) - 1)] if len(fixes) else surfacings
+	valid &= diveEnds < following
 	#
-	# Find the end of each dive (diveState 2 -> 3 or 2 -> 4)
-	diveEnds = np.argwhere(np.logical_or(np.diff(diveState**2, n=1) == 5, np.diff(diveState**2, n=1) == 12))[:,0]+1
-	# diff = np.diff(diveState**2, n=1)
-	# diff_12 = diff==3  ##T diveState change from 1 to 2
-	# diff_13 = diff==8  ##T diveState change from 1 to 3
-	# diff_14 = diff==15  ##T diveState change from 1 to 4
-	# diveEnds = np.argwhere(diff_12+diff_13+diff_14).flatten()
+	# Move the start to the next and the midpoint to the previous valid position, the end to the next
+	# valid position or gps fix
+	positions = np.flatnonzero(~np.isnan(lon))
+	k = np.searchsorted(positions, diveStarts)
+	valid &= k < len(positions)
+	diveStarts = positions[np.minimum(k, len(positions) - 1)] if len(positions) else diveStarts
+	k = np.searchsorted(positions, surfacings, side='right') - 1
+	valid &= k >= 0
+	diveMids = positions[np.maximum(k, 0)] if len(positions) else surfacings
+	ends = np.flatnonzero(~np.isnan(lon) | ~np.isnan(gpsLon.to_numpy(dtype=float)))
+	k = np.searchsorted(ends, diveEnds)
+	valid &= k < len(ends)
+	diveEnds = ends[np.minimum(k, len(ends) - 1)] if len(ends) else diveEnds
+	valid &= diveStarts <= diveMids
+	diveStarts, diveMids, diveEnds = diveStarts[valid], diveMids[valid], diveEnds[valid]
 	#
-	# Remove diveEnds with NaN values
-	for ki in range(len(diveEnds)):
-		while (gliderLon[diveEnds[ki]] != gliderLon[diveEnds[ki]]) and (gpsLon[diveEnds[ki]] != gpsLon[diveEnds[ki]]):
-			diveEnds[ki] = diveEnds[ki] + 1
-	#
-	# Find the midpoint of each dive
-	diveMids = np.argwhere(np.diff(diveState**2, n=1) == 3)[:,0]  #T Doesn't always work.  There are cases with diveState going 1 > 4 > 1.
-	#
-	for ki in range(len(diveMids)):
-		while gliderLon[diveMids[ki]] != gliderLon[diveMids[ki]]:
-			diveMids[ki] = diveMids[ki] - 1
-	#
-	print(diveStarts.shape, diveMids.shape, diveEnds.shape)
 	# Calculate the velocity for longitude and latitude
-	# print(diveStarts,diveStarts.shape)
-	# print(diveMids,diveMids.shape)
-	# print(diveEnds,diveEnds.shape)
-	timeDiff = gliderTimestamp[diveMids].to_numpy() - gliderTimestamp[diveStarts].to_numpy()
-	vlonDD = (gliderLon[diveEnds].to_numpy() - gliderLon[diveMids].to_numpy()) / timeDiff
-	vlatDD = (gliderLat[diveEnds].to_numpy() - gliderLat[diveMids].to_numpy()) / timeDiff
+	with np.errstate(divide='ignore', invalid='ignore'):
+		timeDiff = stamp[diveMids] - stamp[diveStarts]
+		vlonDD = (lon[diveEnds] - lon[diveMids]) / timeDiff
+		vlatDD = (lat[diveEnds] - lat[diveMids]) / timeDiff
 	#
-	# Calculate the corrected latitude and longitude
-	loncDD = np.array(())
-	latcDD = np.array(())
-	ap = np.array(())
-	#
-	for i in range(len(diveStarts)):
-		idtemp = np.arange(diveStarts[i], diveMids[i] + 1)
-		a = (diveStarts[i] + np.argwhere((~gliderLon[idtemp].isna()).to_numpy())).flatten()
-		#
-		# This index is used to introduce "nan's" for padding to match array size to the original array
-		ap = np.hstack((ap, a))
-		if(len(a)==0):
-			continue
-		ti = (gliderTimestamp[a] - gliderTimestamp[a[0]]).to_numpy()  # Changed this line
-		loncDD = np.hstack((loncDD, (gliderLon[a].to_numpy() + ti * vlonDD[i])))
-		latcDD = np.hstack((latcDD, (gliderLat[a].to_numpy() + ti * vlatDD[i])))
+	# Calculate the corrected latitude and longitude of the valid positions of every dive
+	dive = np.searchsorted(diveStarts, positions, side='right') - 1
+	inDive = dive >= 0
+	inDive[inDive] = positions[inDive] <= diveMids[dive[inDive]]
+	rows, dive = positions[inDive], dive[inDive]
+	ti = stamp[rows] - stamp[diveStarts[dive]]
+	correctedLon = np.full(len(lon), np.nan)
+	correctedLat = np.full(len(lat), np.nan)
+	correctedLon[rows] = lon[rows] + ti * vlonDD[dive]
+	correctedLat[rows] = lat[rows] + ti * vlatDD[dive]
 	#
-	# Initialize the output arrays and fill them with the corrected values
-	correctedLon = gliderLon * np.nan
-	correctedLat = gliderLat * np.nan
-	correctedLon.iloc[ap.astype(int)] = loncDD
-	correctedLat.iloc[ap.astype(int)] = latcDD
-	#
-	return correctedLon, correctedLat
+	return pd.Series(correctedLon, index=gliderLon.index, name=gliderLon.name), pd.Series(correctedLat, index=gliderLat.index, name=gliderLat.name)
 
 
 def ignoreBadLatLon(data):
-    filtered_columns = data.filter(regex='lat')
-    filtered_columns = filtered_columns.replace(0, np.nan)
-    filtered_columns = filtered_columns.replace(90, np.nan)
-    filtered_columns = filtered_columns.replace(-90, np.nan)
-    data[filtered_columns.columns] = filtered_columns.replace(0, np.nan)
-    #
-    filtered_columns = data.filter(regex='lon')
-    filtered_columns = filtered_columns.replace(0, np.nan)
-    filtered_columns = filtered_columns.replace(180, np.nan)
-    filtered_columns = filtered_columns.replace(-180, np.nan)
-    data[filtered_columns.columns] = filtered_columns.replace(0, np.nan)
-    #
-    return data
\ No newline at end of file
+	"""
+	Replaces the sentinel positions of the latitude and longitude columns (names containing 'lat' or
+	'lon') with nan, in place: 0 and +-90 for latitudes, 0 and +-180 for longitudes.
+
+	The mask of each column is built from a view of its values and the sentinels are set to nan in the
+	frame's own memory; columns without sentinels aren't touched (integer columns with sentinels become float).
+
+	Args:
+		data (pd.DataFrame): data or glider record.
+
+	Returns:
+		the frame.
+	"""
+	for col, dtype in data.dtypes.items():
+		limits = [limit for pattern, limit in (('lat', 90), ('lon', 180)) if pattern in str(col)]
+		if not limits or dtype.kind not in 'fiu':
+			continue
+		values = data[col].to_numpy()
+		magnitude = np.abs(values)
+		bad = magnitude == 0
+		for limit in limits:
+			bad |= magnitude == limit
+		if bad.any():
+			if dtype.kind != 'f':
+				data[col] = values.astype(float)
+			data.loc[bad, col] = np.nan
+	return data
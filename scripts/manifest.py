@@ -0,0 +1,91 @@
+import os
+import json
+from bdcache import fileFingerprint, saveFrames, loadFrames
+
+MANIFEST_VERSION = 1
+
+
+def loadManifest(filename):
+	"""
+	Reads the mission manifest: for every raw segment, the fingerprint of its input files,
+	its file number, the profile file it produced and its cached intermediate results, the
+	fingerprints of the metadata and encoder the attributes were written from and of the type
+	policy of the glider record, and the tolerance the flight and science records were merged with.
+
+	Returns an empty manifest if the file does not exist, is unreadable or has an older layout.
+	"""
+	empty = {'version': MANIFEST_VERSION, 'segments': {}, 'trajectory': None, 'attributes': None, 'dtypes': None, 'mergeTolerance': None, 'positions': 'mean'}
+	if not os.path.isfile(filename):
+		return empty
+	try:
+		with open(filename, 'r') as fid:
+			manifest = json.load(fid)
+	except (OSError, ValueError):
+		return empty
+	if manifest.get('version') != MANIFEST_VERSION:
+		return empty
+	return manifest
+
+
+def saveManifest(filename, manifest):
+	tmpFilename = '%s.%d.tmp' % (filename, os.getpid())
+	with open(tmpFilename, 'w') as fid:
+		json.dump(manifest, fid, indent=1, sort_keys=True)
+	os.replace(tmpFilename, filename)
+
+
+def segmentInputs(filenames, known=None):
+	"""
+	Fingerprints of the raw files of a segment (e.g. the DBD/EBD or SBD/TBD pair); missing files are skipped.
+	The fingerprints in known (e.g. the inputs recorded in the manifest) are reused for the files whose
+	size and modification time are unchanged, without hashing them again.
+	"""
+	inputs = {}
+	for f in filenames:
+		if not os.path.isfile(f):
+			continue
+		name = os.path.basename(f)
+		stat = os.stat(f)
+		previous = (known or {}).get(name)
+		if previous is not None and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime:
+			inputs[name] = previous
+		else:
+			inputs[name] = fileFingerprint(f)
+	return inputs
+
+
+def isSegmentCurrent(entry, inputs, fileNumber):
+	"""
+	A segment is up to date if its raw files and file number (which offsets the profile ids) did not change
+	and the outputs recorded for it still exist.
+	"""
+	if entry is None or entry.get('inputs') != inputs or entry.get('fileNumber') != fileNumber:
+		return False
+	if entry.get('result') is None:
+		return True
+	return os.path.isfile(entry['result']) and os.path.isfile(entry['ncFilename'])
+
+
+def attributeInputs(metadataFile, encoderFile):
+	"""
+	Content hashes of the files the attributes of every output file come from (mission metadata and encoder).
+	"""
+	return {'metadata': fileFingerprint(metadataFile)['sha1'], 'encoder': fileFingerprint(encoderFile)['sha1']}
+
+
+def saveResult(filename, data, gliderData, ncFilename):
+	"""
+	Stores the processed frames of a segment so the trajectory can be rebuilt without reprocessing it.
+	"""
+	saveFrames(filename, {'ncFilename': ncFilename}, data=data, gliderData=gliderData)
+
+
+def loadResult(filename):
+	"""
+	Reads the processed frames of a segment written by saveResult.
+
+	Returns:
+		data, gliderData, ncFilename
+	"""
+	meta, frames = loadFrames(filename)
+	return frames['data'], frames['gliderData'], meta['ncFilename']
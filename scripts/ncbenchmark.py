@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Write time against file size of the netCDF output settings (see attributes/netcdf_output.yml).
+
+Writes the profile files and the trajectory file of a processed mission again from the stored segment
+results (../segments, next to raw and nc) with several compression, chunking and type settings, and
+reports the time and total size of each.  Run from the mission's raw directory after bd2nc.py, e.g.
+
+	python ../../../scripts/ncbenchmark.py --mode=delayed --metadataFile=metadata.yml
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import warnings
+
+scriptsDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, scriptsDir)
+
+from manifest import loadResult
+from trajectory import buildTrajectory
+from data2attr import saveNetcdf, outputSettings
+
+# name, changes to the default settings
+SETTINGS = [
+	('no compression', {'complevel': 0, 'shuffle': False}),
+	('zlib 1', {'complevel': 1}),
+	('zlib 5 (default)', {}),
+	('zlib 9', {'complevel': 9}),
+	('zlib 5, no shuffle', {'shuffle': False}),
+	('zlib 5, 4096 chunks', {'chunk': 4096}),
+	('zlib 1, float32 sensors', {'complevel': 1, 'float32': True}),
+	('zlib 5, float32 sensors', {'float32': True}),
+	('zlib 5, gathered record', {'gliderRecord': 'gathered'}),
+]
+
+# variables kept in double precision when testing float32 storage
+DOUBLE_VARIABLES = ('time', 'lat', 'lon', 'time_uv', 'lat_uv', 'lon_uv', 'profile_time', 'profile_lat', 'profile_lon', 'm_present_time', 'sci_m_present_time')
+
+
+def writeAll(results, trajectory, sourceInfo, outDir, settings):
+	"""
+	Writes every profile file and the trajectory file into outDir.
+
+	Returns:
+		seconds, bytes
+	"""
+	start = time.perf_counter()
+	for name, (data, gliderData, ncFilename) in results.items():
+		info = dict(sourceInfo, dataType='profile', bdFilename=name, ncFilename=os.path.join(outDir, os.path.basename(ncFilename)))
+		saveNetcdf(data, gliderData, info, settings)
+	info = dict(sourceInfo, dataType='trajectory', bdFilename='', ncFilename=os.path.join(outDir, 'trajectory.nc'))
+	saveNetcdf(trajectory[0], trajectory[1], info, settings)
+	seconds = time.perf_counter() - start
+	size = sum(os.path.getsize(f) for f in glob.glob(os.path.join(outDir, '*.nc')))
+	return seconds, size
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--mode', default='delayed', help='Processing mode (realtime | delayed)')
+	parser.add_argument('--metadataFile', help='Metadata file path (relative to the mission directory)')
+	parser.add_argument('--repeat', type=int, default=1, help='Number of runs of each setting (the fastest is reported)')
+	args = parser.parse_args()
+	warnings.simplefilter("ignore", category=RuntimeWarning)
+
+	resultFilenames = sorted(glob.glob('../segments/*_%s.result.npz' % args.mode))
+	if not resultFilenames:
+		sys.exit("No stored segment results in ../segments; run bd2nc.py first.")
+	results = {}
+	for f in resultFilenames:
+		results[os.path.basename(f).split('_')[0]] = loadResult(f)
+	trajectory = buildTrajectory([(data, gliderData) for data, gliderData, ncFilename in results.values()])
+	floatVariables = {col for data, gliderData, ncFilename in results.values() for frame in (data, gliderData)
+					  for col in frame.columns if frame[col].dtype == 'float64' and col not in DOUBLE_VARIABLES}
+
+	sourceInfo = {
+		'metadataFile': os.path.join(os.path.abspath('../..'), args.metadataFile),
+		'encoder': os.path.join(scriptsDir, 'attributes', 'glider_dac_3.0_conventions.yml'),
+		'processingMode': args.mode,
+		'datetime': time.strftime('%FT%TZ', time.gmtime()),
+	}
+	print("%d segments, %d trajectory rows" % (len(results), len(trajectory[0])))
+	print("%-26s %10s %10s" % ('setting', 'seconds', 'MB'))
+	for name, changes in SETTINGS:
+		settings = outputSettings(dict(sourceInfo, dataType='profile'))
+		settings.update({k: v for k, v in changes.items() if k != 'float32'})
+		if changes.get('float32'):
+			settings['dtypes'] = dict.fromkeys(floatVariables, 'f4')
+		timings = []
+		for i in range(args.repeat):
+			outDir = tempfile.mkdtemp(prefix='ncbenchmark')
+			try:
+				timings.append(writeAll(results, trajectory, sourceInfo, outDir, settings))
+			finally:
+				shutil.rmtree(outDir)
+		seconds, size = min(timings)
+		print("%-26s %10.2f %10.1f" % (name, seconds, size / 2**20))
@@ -0,0 +1,91 @@
+import os
+import multiprocessing
+import numpy as np
+import netCDF4
+from quartod_qc import loadQCthresholds, quartodQCbatch
+from bdcache import loadFrames, saveFrames
+
+
+def reqcProfile(args):
+	"""
+	Pool worker: reruns the QARTOD tests on the variables stored in a profile file and rewrites its
+	*_qc variables in place.  The stored segment result (if any) gets the same flags, so a later
+	trajectory rebuild uses them too; it is removed if it doesn't match the file.
+
+	Args:
+		args: (ncFilename, resultFilename or None, thresholdsFile or None)
+
+	Returns:
+		time (np.ndarray), flags (dict of np.ndarray keyed by *_qc variable name)
+	"""
+	ncFilename, resultFilename, thresholdsFile = args
+	thresholds = loadQCthresholds(thresholdsFile)
+	with netCDF4.Dataset(ncFilename, 'r+') as nc:
+		nc.set_auto_mask(False)
+		names = [k for k in thresholds if k in nc.variables and k + '_qc' in nc.variables]
+		time = nc.variables['time'][:]
+		flags = quartodQCbatch({k: nc.variables[k][:] for k in names}, time, names, thresholdsFile)
+		for QCvariable, QCflag in flags.items():
+			nc.variables[QCvariable][:] = QCflag
+	#
+	if resultFilename is not None and os.path.isfile(resultFilename):
+		meta, frames = loadFrames(resultFilename)
+		data = frames['data']
+		if len(data) == len(time) and np.array_equal(data['time'].to_numpy(), time) and set(flags) <= set(data.columns):
+			for QCvariable, QCflag in flags.items():
+				data[QCvariable] = QCflag.astype(data[QCvariable].dtype)
+			saveFrames(resultFilename, meta, **frames)
+		else:
+			os.remove(resultFilename)  # the segment is processed again on the next run
+	return time, flags
+
+
+def reqcTrajectory(ncFilename, profileFlags):
+	"""
+	Rewrites the *_qc variables of a trajectory file with the flags of its profile files.  Trajectory
+	rows are matched to the profile rows by time; rows without a match keep their flags.
+
+	Args:
+		ncFilename (str): trajectory file.
+		profileFlags (list): (time, flags) of each profile file, as returned by reqcProfile.
+	"""
+	profileTime = np.concatenate([t for t, flags in profileFlags]) if profileFlags else []
+	if len(profileTime) == 0:
+		return
+	order = np.argsort(profileTime, kind='stable')
+	profileTime = profileTime[order]
+	with netCDF4.Dataset(ncFilename, 'r+') as nc:
+		nc.set_auto_mask(False)
+		time = nc.variables['time'][:]
+		idx = np.minimum(np.searchsorted(profileTime, time), len(profileTime) - 1)
+		matched = profileTime[idx] == time
+		for QCvariable in profileFlags[0][1]:
+			if QCvariable not in nc.variables or not all(QCvariable in flags for t, flags in profileFlags):
+				continue
+			QCflag = np.concatenate([flags[QCvariable] for t, flags in profileFlags])[order]
+			values = nc.variables[QCvariable][:]
+			values[matched] = QCflag[idx[matched]]
+			nc.variables[QCvariable][:] = values
+
+
+def reqcFiles(ncFilenames, trajectoryFilename, resultFilenames=None, workers=1, thresholdsFile=None):
+	"""
+	Applies the current QC thresholds to existing output files without decoding or processing the
+	raw data again: the profile files are updated in parallel, then the trajectory file.
+
+	Args:
+		ncFilenames (list): profile files.
+		trajectoryFilename (str): trajectory file (skipped if it doesn't exist).
+		resultFilenames (dict): stored segment result of each profile file.
+		workers (int): number of worker processes.
+		thresholdsFile (str): QC thresholds table (default: the one next to the encoder).
+	"""
+	if resultFilenames is None:
+		resultFilenames = {}
+	tasks = [(f, resultFilenames.get(f), thresholdsFile) for f in ncFilenames]
+	with multiprocessing.Pool(max(1, min(workers, len(tasks)))) as p:
+		profileFlags = p.map(reqcProfile, tasks, chunksize=1)
+	if os.path.exists(trajectoryFilename):
+		reqcTrajectory(trajectoryFilename, profileFlags)
+	print("QC flags updated in %d profile files%s." % (
+		len(ncFilenames), ' and the trajectory file' if os.path.exists(trajectoryFilename) else ''))
@@ -1,180 +1,194 @@
+import os
+import math
+import yaml
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 # import pandas as pd
 
-def getQCoptions(variableName):
-	if variableName == 'oxygen_concentration':
-		QCoptions = {
-			'sensorMin': 0.1,
-			'sensorMax': 500,
-			'sensor_userMin': 0.1,
-			'sensor_userMax': 450,
-			'spike_thrshldLow': 4,
-			'spike_thrshldHigh': 8,
-			'nDev': 3,
-			'time_dev': 300/3600,
-			'min_wind_size': 10,
-			'eps': 1e-6,
-			'repCntFail': 5,
-			'repCntSuspect': 3
-		}
-	elif variableName == 'salinity':
-		QCoptions = {
-			'sensorMin': 2,
-			'sensorMax': 40,
-			'sensor_userMin': 10,
-			'sensor_userMax': 37,
-			'spike_thrshldLow': 0.3,
-			'spike_thrshldHigh': 0.9,
-			'nDev': 3,
-			'time_dev': 300/3600,
-			'min_wind_size': 10,
-			'eps': 1e-6,
-			'repCntFail': 5,
-			'repCntSuspect': 3
-		}
-	elif variableName == 'conductivity':
-		QCoptions = {
-			'sensorMin': 0,
-			'sensorMax': 10,
-			'sensor_userMin': 0.01,
-			'sensor_userMax': 6,
-			'spike_thrshldLow': 0.3,
-			'spike_thrshldHigh': 0.9,
-			'nDev': 3,
-			'time_dev': 300/3600,
-			'min_wind_size': 10,
-			'eps': 1e-6,
-			'repCntFail': 5,
-			'repCntSuspect': 3
-		}
-	elif variableName == 'density':
-		QCoptions = {
-			'sensorMin': 999,
-			'sensorMax': 1040,
-			'sensor_userMin': 1015,
-			'sensor_userMax': 1035,
-			'spike_thrshldLow': 0.3,
-			'spike_thrshldHigh': 0.9,
-			'nDev': 3,
-			'time_dev': 300/3600,
-			'min_wind_size': 10,
-			'eps': 1e-6,
-			'repCntFail': 5,
-			'repCntSuspect': 3
-		}
-	elif variableName == 'temperature':
-		QCoptions = {
-			'sensorMin': -2,
-			'sensorMax': 40,
-			'sensor_userMin': -1.89,
-			'sensor_userMax': 30,
-			'spike_thrshldLow': 0.5,
-			'spike_thrshldHigh': 1.5,
-			'nDev': 3,
-			'time_dev': 300/3600,
-			'min_wind_size': 10,
-			'eps': 0.05,
-			'repCntFail': 5,
-			'repCntSuspect': 3
-		}
-	elif variableName == 'pressure':
-		QCoptions = {
-			'sensorMin': -2,
-			'sensorMax': 1200,
-			'sensor_userMin': -2,
-			'sensor_userMax': 1200,
-			'spike_thrshldLow': 4,
-			'spike_thrshldHigh': 8,
-			'nDev': 3,
-			'time_dev': 300/3600,
-			'min_wind_size': 10,
-			'eps': 0.001,
-			'repCntFail': 5,
-			'repCntSuspect': 3
-		}
-	else:
+# Per-variable test thresholds, next to the IOOS encoder
+QCthresholdsFile = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'attributes', 'quartod_qc_thresholds.yml')
+_QCthresholds = {}
+
+
+def loadQCthresholds(filename=None):
+	"""
+	Reads the QC thresholds table (variable name -> test options); the table is read once per
+	process and again only if the file changes.
+	"""
+	if filename is None:
+		filename = QCthresholdsFile
+	mtime = os.path.getmtime(filename)
+	if filename not in _QCthresholds or _QCthresholds[filename][0] != mtime:
+		with open(filename, 'r') as f:
+			_QCthresholds[filename] = (mtime, yaml.safe_load(f))
+	return _QCthresholds[filename][1]
+
+
+def getQCoptions(variableName, thresholdsFile=None):
+	thresholds = loadQCthresholds(thresholdsFile)
+	if variableName not in thresholds:
 		raise ValueError(f"Unknown variableName '{variableName}'")
-		
-	return QCoptions
+	return dict(thresholds[variableName])
 
 def rangeCheckTest(var, QCflag, sensorMin=-2, sensorMax=1200, userMin=-2, userMax=1200):
-	for i, value in enumerate(var):
-		if np.isnan(value):
-			continue
-		if value < sensorMin or value > sensorMax:
-			QCflag[i] = 4
-		elif value < userMin or value > userMax:
-			QCflag[i] = 3
+	var = np.asarray(var)
+	# comparisons with nan are False, so missing values are never flagged
+	fail = (var < sensorMin) | (var > sensorMax)
+	suspect = ~fail & ((var < userMin) | (var > userMax))
+	QCflag[fail] = 4
+	QCflag[suspect] = 3
 	return QCflag
 
 def spikeTest(var, QCflag, thrshldLow=4, thrshldHigh=8):
 	var = np.asarray(var)
-	nonNANindices = np.where(~np.isnan(var))[0]
-
-	for i in nonNANindices[1:-1]:
-		if np.isnan(var[i]):
-			continue
-		spkRef = (var[i - 1] + var[i + 1]) / 2
-		spike = np.abs(var[i] - spkRef)
-		if thrshldLow < spike <= thrshldHigh:
-			QCflag[i] = 3
-		elif spike > thrshldHigh:
-			QCflag[i] = 4
+	# every valid value except the first and last one (along the last axis), compared with its direct
+	# neighbours (a nan neighbour gives a nan spike, which is not flagged)
+	valid = ~np.isnan(var)
+	nValid = np.cumsum(valid, axis=-1)
+	inner = valid & (nValid > 1) & (nValid < nValid[..., -1:])
+	spike = np.full(var.shape, np.nan)
+	spike[..., 1:-1] = np.abs(var[..., 1:-1] - (var[..., :-2] + var[..., 2:]) / 2)
+	QCflag[inner & (thrshldLow < spike) & (spike <= thrshldHigh)] = 3
+	QCflag[inner & (spike > thrshldHigh)] = 4
 	return QCflag
 
 
 def rateOfChangeTest(var, time, QCflag, nDev=3, timDev=25, minWindowSize=3):
-	if not isinstance(time[0], np.datetime64):
+	"""
+	Flags (3) samples whose rate of change exceeds the mean + nDev standard deviations of the rates of
+	change of the preceding samples within timDev hours (whole hours).
+
+	The windows are found with a two-pointer search on the (increasing) time axis and their mean and
+	standard deviation come from running sums and sums of squares, so the cost is linear in the number
+	of samples. Steps with a missing time are skipped and not part of any window. The few samples whose
+	rate is within the rounding error of the running sums from the threshold (ties, e.g. repeated values)
+	are decided from the rates of their window, so the flags are those of the per-sample window statistics.
+	"""
+	var = np.asarray(var)
+	time = np.asarray(time)
+	if not np.issubdtype(time.dtype, np.datetime64):
 		time = np.array(time, dtype='datetime64[ns]')
+	if len(var) < 2:
+		return QCflag
+
+	# samples tested: both values present and a positive time step (in whole seconds)
+	timeDiff = np.diff(time).astype('timedelta64[s]').astype(float) / 3600
+	tested = np.flatnonzero(~np.isnan(var[1:]) & ~np.isnan(var[:-1]) & (timeDiff > 0)) + 1
+	if len(tested) == 0:
+		return QCflag
+	rateOfChange = np.abs(var[tested] - var[tested - 1]) / (timeDiff[tested - 1] + 1e-8)
+
+	# every tested sample adds the previous sample to the window; older entries leave the window once
+	# they are timDev (whole) hours or more before the tested sample
+	windowTime = time[tested - 1]
+	windowValue = var[tested - 1]
+	position = np.arange(len(tested))
+	windowStart = np.searchsorted(windowTime, time[tested] - np.timedelta64(math.ceil(timDev), 'h'), side='right')
+	windowStart = np.minimum(windowStart, position)
+	windowSize = position - windowStart + 1
+
+	# mean and sample standard deviation of the rates between consecutive window entries from running
+	# sums (centred for accuracy); rates[k] is between entries k and k+1, so the window uses rates[start:position]
+	rates = np.diff(windowValue) / np.diff(windowTime.astype(float))
+	centre = np.mean(rates) if len(rates) else 0.0
+	sums = np.concatenate(([0], np.cumsum(rates - centre)))
+	sumsAbsolute = np.concatenate(([0], np.cumsum(np.abs(rates - centre))))
+	sumsSquared = np.concatenate(([0], np.cumsum((rates - centre)**2)))
+	nRates = windowSize - 1
+	with np.errstate(invalid='ignore', divide='ignore'):
+		rateSum = sums[position] - sums[windowStart]
+		meanRate = centre + rateSum / nRates
+		variance = np.maximum((sumsSquared[position] - sumsSquared[windowStart] - rateSum * rateSum / nRates) / (nRates - 1), 0)
+		threshold = meanRate + nDev * np.sqrt(variance)
+		# bound of the rounding error of the running sums (prefix sums of absolute values)
+		meanError = np.abs(centre) * 4 * np.finfo(float).eps + 16 * np.finfo(float).eps * sumsAbsolute[position] / nRates
+		varianceError = 16 * np.finfo(float).eps * (sumsSquared[position] + rateSum * rateSum / nRates) / (nRates - 1)
+		tolerance = meanError + nDev * varianceError / (np.sqrt(variance) + np.sqrt(varianceError))
+
+	# fewer than 2 rates have no (sample) standard deviation, and are never flagged
+	eligible = (windowSize >= minWindowSize) & (nRates >= 2)
+	flagged = eligible & (rateOfChange > threshold)
+	for k in np.flatnonzero(eligible & (np.abs(rateOfChange - threshold) <= tolerance)):
+		windowRates = rates[windowStart[k]:position[k]]
+		flagged[k] = rateOfChange[k] > np.mean(windowRates) + nDev * np.std(windowRates, ddof=1)
+	QCflag[tested[flagged]] = 3
+	return QCflag
 
-	recentData = []
-	for i in range(1, len(var)):
-		if np.isnan(var[i]) or np.isnan(var[i - 1]):
-			continue
-		
-		timeDiff = (time[i] - time[i - 1]).astype('timedelta64[s]').astype(float) / 3600
-		if timeDiff <= 0:
-			continue
-		
-		rateOfChange = np.abs(var[i] - var[i - 1]) / (timeDiff + 1e-8)
-		recentData = [(t, v) for t, v in recentData if (time[i] - t).astype('timedelta64[h]').astype(float) < timDev]
-		recentData.append((time[i - 1], var[i - 1]))
-
-		if len(recentData) < minWindowSize:
-			continue
-
-		values = [v for t, v in recentData]
-		ratesOfChange = np.diff(values) / np.diff([t.astype(float) for t, _ in recentData])  # Calculate rates of change
-		meanRate = np.mean(ratesOfChange)
-		sd = np.std(ratesOfChange, ddof=1)
-		threshold = meanRate + nDev * sd
-
-		if rateOfChange > threshold:
-			QCflag[i] = 3
 
+def flatLineTest(var, QCflag, eps=1e-6, repCntFail=5, repCntSuspect=3):
+	var = np.asarray(var)
+	if var.shape[-1] < 2:
+		return QCflag
+	bothValid = ~np.isnan(var[..., 1:]) & ~np.isnan(var[..., :-1])
+	repeated = np.abs(np.diff(var, axis=-1)) < eps
+	# length of the run of repeated values ending at each sample (run-length encoding of `repeated`)
+	runs = np.cumsum(repeated, axis=-1)
+	repeatCount = runs - np.maximum.accumulate(np.where(repeated, 0, runs), axis=-1)
+	check = bothValid & ~np.isclose(var[..., 1:], 0, atol=1e-8)
+	QCflag[..., 1:][check & (repeatCount >= repCntSuspect - 1) & (repeatCount < repCntFail - 1)] = 3
+	QCflag[..., 1:][check & (repeatCount >= repCntFail - 1)] = 4
 	return QCflag
 
 
-def flatLineTest(var, QCflag, eps=1e-6, repCntFail=5, repCntSuspect=3):
-	repeatCount = 0
-
-	for i in range(1, len(var)):
-		if np.isnan(var[i]) or np.isnan(var[i - 1]):
-			repeatCount = 0
-			continue
-		if abs(var[i] - var[i - 1]) < eps:
-			repeatCount += 1
-		else:
-			repeatCount = 0
-
-		if not np.isclose(var[i], 0, atol=1e-8):
-			if repeatCount >= repCntFail - 1:
-				QCflag[i] = 4
-			elif repeatCount >= repCntSuspect - 1:
-				QCflag[i] = 3
+def runQCtests(var, time, QCoptions, threads=None):
+	"""
+	Runs the four QARTOD tests on several variables sharing one time axis.
+
+	:param var: 2-D array, the data to test, one row per variable
+	:param time: array-like, the time of the samples (converted once for all variables)
+	:param QCoptions: list, the test options of each row
+	:param threads: int, optional, number of threads for the rate of change test (one variable per thread)
+	:return: 2-D array, the flags, one row per variable
+	"""
+	QCflag = np.ones(var.shape, dtype=int)
+	QCflag[np.isnan(var) | np.isclose(var, 0, atol=1e-8)] = 9
+
+	def option(key):
+		# one threshold per row, broadcast along the samples
+		return np.array([o[key] for o in QCoptions])[:, np.newaxis]
+
+	time = np.asarray(time)
+	if not np.issubdtype(time.dtype, np.datetime64):
+		time = np.array(time, dtype='datetime64[ns]')
+
+	# test 1 - range check
+	rangeCheckTest(var, QCflag, option('sensorMin'), option('sensorMax'), option('sensor_userMin'), option('sensor_userMax'))
+	# test 2 - spike test
+	spikeTest(var, QCflag, option('spike_thrshldLow'), option('spike_thrshldHigh'))
+	# test 3 - rate of change test (windows depend on the missing values of each variable)
+	def rateOfChange(i):
+		rateOfChangeTest(var[i], time, QCflag[i], QCoptions[i]['nDev'], QCoptions[i]['time_dev'], QCoptions[i]['min_wind_size'])
+	if threads is not None and threads > 1 and len(var) > 1:
+		with ThreadPoolExecutor(max_workers=threads) as executor:
+			list(executor.map(rateOfChange, range(len(var))))
+	else:
+		for i in range(len(var)):
+			rateOfChange(i)
+	# test 4 - flat line test
+	flatLineTest(var, QCflag, option('eps'), option('repCntFail'), option('repCntSuspect'))
+
 	return QCflag
 
 
+def quartodQCbatch(data, time, variableNames, thresholdsFile=None, threads=None):
+	"""
+	Performs the QARTOD Quality Control Checks (see quartodQCchecks) on several variables at once
+
+	:param data: pd.DataFrame or dict, the data to test
+	:param time: array-like, the time associated with the data
+	:param variableNames: list, the names of the variables to test (each needs an entry in the thresholds table)
+	:param thresholdsFile: string, optional, QC thresholds table (default: quartod_qc_thresholds.yml next to the encoder)
+	:param threads: int, optional, number of threads
+	:return: dict, the flags of each variable keyed by '<variableName>_qc'
+	"""
+	if len(variableNames) == 0:
+		return {}
+	QCoptions = [getQCoptions(k, thresholdsFile) for k in variableNames]
+	var = np.vstack([np.asarray(data[k], dtype=float) for k in variableNames])
+	QCflag = runQCtests(var, time, QCoptions, threads)
+	return {k + '_qc': QCflag[i] for i, k in enumerate(variableNames)}
+
+
 def quartodQCchecks(var, time, variableName, QCoptions=None):
 	"""
 	Performs Quality Control Checks on data following US QUARTOD Protocol and Standards
@@ -191,32 +205,8 @@ def quartodQCchecks(var, time, variableName, QCoptions=None):
 	:return: array-like, the flags for each data point (1: Pass, 2: Not tested, 3: Suspect, 4: Fail, 9: Missing Data)
 	"""
 
-	# create qc flag variable from var
-	# set initially the flag to "one" which is "pass"
-	var = np.asarray(var)
-	QCflag = np.ones_like(var, dtype=int)
-
-	# Set missing data flag to 9 or data points that are exactly zero
-	QCflag[np.isnan(var) | np.isclose(var, 0, atol=1e-8)] = 9
-
 	# for different variables (e.g. salinity) there are different thresholds for the tests
 	if QCoptions is None:
 		QCoptions = getQCoptions(variableName)
 
-	# test 1 - range check
-	QCflag = rangeCheckTest(var, QCflag, QCoptions['sensorMin'], QCoptions['sensorMax'], QCoptions['sensor_userMin'], QCoptions['sensor_userMax'])
-	#print('done: test 1 - range check test for variable '+variableName)
-
-	# test 2 - spike test
-	QCflag = spikeTest(var, QCflag, QCoptions['spike_thrshldLow'], QCoptions['spike_thrshldHigh'])
-	#print('done: test 2 - spike test for variable '+variableName)
-
-	# test 3 - rate of change test
-	QCflag = rateOfChangeTest(var, time, QCflag, QCoptions['nDev'], QCoptions['time_dev'],QCoptions['min_wind_size'])
-	#print('done: test 3 - rate of change test for variable '+variableName)
-
-	# test 4 - flat line test
-	QCflag = flatLineTest(var, QCflag, QCoptions['eps'], QCoptions['repCntFail'], QCoptions['repCntSuspect'])
-	#print('done: test 4 - flat line test for variable '+variableName)
-
-	return QCflag
\ No newline at end of file
+	return runQCtests(np.asarray(var, dtype=float)[np.newaxis, :], time, [QCoptions])[0]
@@ -0,0 +1,114 @@
+import os
+import re
+import threading
+
+# Rough peak memory of processing a segment per byte of raw (binary) input, and of an idle worker
+MEMORY_PER_RAW_BYTE = 25
+WORKER_MEMORY = 256 * 2**20
+
+
+def parseSize(size):
+	"""
+	Converts a memory size like '8G', '512M' or '1073741824' to bytes.
+	"""
+	match = re.fullmatch(r'\s*([0-9.]+)\s*([kKmMgGtT]?)[bB]?\s*', str(size))
+	if match is None:
+		raise ValueError("Invalid memory size '%s' (use e.g. 512M or 8G)" % size)
+	return int(float(match.group(1)) * 1024**' KMGT'.index(match.group(2).upper() or ' '))
+
+
+def availableCores():
+	try:
+		return len(os.sched_getaffinity(0))
+	except AttributeError:
+		return os.cpu_count() or 1
+
+
+def availableMemory():
+	"""
+	Memory available for new processes in bytes (MemAvailable on Linux), or None if unknown.
+	"""
+	try:
+		with open('/proc/meminfo', 'r') as fid:
+			for line in fid:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	try:
+		return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+	except (ValueError, OSError, AttributeError):
+		return None
+
+
+def schedulerSettings(workers=None, maxMemory=None, nTasks=None):
+	"""
+	Number of worker processes and memory budget of the segment processing pool.
+
+	Args:
+		workers (int): requested number of workers (default: available cores, limited by memory).
+		maxMemory (str|int): memory budget for the tasks in flight (default: 80% of the available memory).
+		nTasks (int): number of tasks to run (no more workers than tasks are started).
+
+	Returns:
+		workers (int), maxMemory (int, bytes)
+	"""
+	if maxMemory is None:
+		available = availableMemory()
+		maxMemory = int(0.8 * available) if available else 8 * 2**30
+	else:
+		maxMemory = parseSize(maxMemory)
+	if workers is None:
+		workers = min(availableCores(), max(1, maxMemory // WORKER_MEMORY))
+	if nTasks is not None:
+		workers = min(workers, max(1, nTasks))
+	return max(1, int(workers)), maxMemory
+
+
+def indexedCall(args):
+	func, index, task = args
+	return index, func(task)
+
+
+def runScheduled(pool, func, tasks, costs, maxInFlight):
+	"""
+	Runs func over tasks on a process pool, largest task first, keeping the estimated memory of the
+	tasks in flight under maxInFlight (a single task larger than the budget runs alone).
+
+	Results are yielded as soon as each task completes (imap_unordered), so the caller can consume them
+	while the remaining tasks are still running.
+
+	Args:
+		pool (multiprocessing.Pool): worker pool.
+		func: picklable function applied to each task.
+		tasks (list): task arguments.
+		costs (list): estimated peak memory of each task in bytes.
+		maxInFlight (int): memory budget in bytes.
+
+	Yields:
+		(task, result) in completion order.
+	"""
+	order = sorted(range(len(tasks)), key=lambda i: costs[i], reverse=True)
+	state = {'inFlight': 0, 'stop': False}
+	condition = threading.Condition()
+	#
+	def admitted():
+		# consumed by the pool's task handler thread: blocks until the budget allows the next task
+		for i in order:
+			with condition:
+				condition.wait_for(lambda: state['stop'] or state['inFlight'] == 0 or state['inFlight'] + costs[i] <= maxInFlight)
+				if state['stop']:
+					return
+				state['inFlight'] += costs[i]
+			yield func, i, tasks[i]
+	#
+	try:
+		for i, result in pool.imap_unordered(indexedCall, admitted(), chunksize=1):
+			with condition:
+				state['inFlight'] -= costs[i]
+				condition.notify_all()
+			yield tasks[i], result
+	finally:
+		with condition:
+			state['stop'] = True
+			condition.notify_all()
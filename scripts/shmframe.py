@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory, resource_tracker
+
+
+def startTracker():
+	"""
+	Starts the shared memory resource tracker in the parent process before forking workers, so
+	blocks published by a worker are tracked by the parent and survive the worker's exit.
+	"""
+	resource_tracker.ensure_running()
+
+
+def publishFrames(**frames):
+	"""
+	Copies the columns of data frames into one shared memory block.
+
+	Args:
+		**frames: pd.DataFrame objects with numeric columns, keyed by name.
+
+	Returns:
+		A small descriptor (block name and column layout) to hand to attachFrames in another process.
+	"""
+	layout = {}
+	offset = 0
+	for name, frame in frames.items():
+		columns = []
+		for col in frame.columns:
+			dtype = frame[col].dtype
+			if dtype.hasobject:
+				raise ValueError("Column '%s' of '%s' is not numeric" % (col, name))
+			columns.append((col, dtype.str, offset))
+			offset += -(-len(frame) * dtype.itemsize // 8) * 8  # keep every column 8-byte aligned
+		layout[name] = {'rows': len(frame), 'columns': columns}
+	#
+	shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+	try:
+		for name, frame in frames.items():
+			for col, dtype, colOffset in layout[name]['columns']:
+				np.ndarray(len(frame), dtype=dtype, buffer=shm.buf, offset=colOffset)[:] = frame[col].to_numpy()
+	except BaseException:
+		shm.close()
+		shm.unlink()
+		raise
+	descriptor = {'name': shm.name, 'frames': layout}
+	shm.close()
+	return descriptor
+
+
+def attachFrames(descriptor):
+	"""
+	Rebuilds the data frames published by publishFrames and releases the shared memory block.
+
+	Returns:
+		dict of pd.DataFrame, keyed by name.
+	"""
+	shm = shared_memory.SharedMemory(name=descriptor['name'])
+	try:
+		frames = {}
+		for name, layout in descriptor['frames'].items():
+			frames[name] = pd.DataFrame(
+				{col: np.ndarray(layout['rows'], dtype=dtype, buffer=shm.buf, offset=offset).copy()
+				 for col, dtype, offset in layout['columns']},
+				columns=[col for col, dtype, offset in layout['columns']], copy=False)
+	finally:
+		shm.close()
+		shm.unlink()
+	return frames
@@ -0,0 +1,374 @@
+import numpy as np
+import pandas as pd
+import netCDF4
+from gliderfuncs import findProfiles, findProfilesChunk, resumeProfiles, correctDeadReckoning, ignoreBadLatLon
+from bdcache import frameLayout, loadFrames
+from data2attr import saveNetcdf, refreshDataAttributes, gliderRecordValues
+from dtypepolicy import compactFrame, floatColumn
+
+
+def concatSegments(results):
+	"""
+	Concatenates the processed segments in time order and masks invalid positions.
+
+	Args:
+		results (list): (data, gliderData) tuples, one per segment.
+
+	Returns:
+		allData, allGliderData (pd.DataFrame)
+	"""
+	allData = pd.concat([df[0] for df in results], ignore_index=True, sort=True)
+	allGliderData = pd.concat([df[1] for df in results], ignore_index=True, sort=True)
+	# the rows of both frames match (one row per merged sample), so both are put in the same time order
+	order = np.argsort(allData['time'].to_numpy(), kind='stable')
+	allData = ignoreBadLatLon(allData.iloc[order].reset_index())
+	allGliderData = compactFrame(ignoreBadLatLon(allGliderData.iloc[order].reset_index()))
+	#
+	# REMOVE DUPLICATE ROWS (or profile_index is messed up!), from both frames so they stay row-aligned
+	unique = ~allData['time'].duplicated().to_numpy()
+	return allData[unique], allGliderData[unique]
+
+
+def deadReckonedPositions(gliderData):
+	"""
+	Corrected underwater positions (lon_qc, lat_qc) from the glider record, or None if they cannot be derived.
+	"""
+	if 'x_dr_state' in gliderData.keys() and np.all([key in gliderData.keys() for key in ['m_gps_lon', 'm_gps_lat', 'm_lat', 'm_lon']]):
+		try:
+			return correctDeadReckoning(
+				gliderData['m_lon'], gliderData['m_lat'], gliderData['time'], floatColumn(gliderData, 'x_dr_state'), gliderData['m_gps_lon'], gliderData['m_gps_lat'])
+		except:
+			print("##  Dead Reckoning Correction FAILED.  No lon_qc/lat_qc generated.")
+	elif 'm_lat' in gliderData and 'm_lon' in gliderData:
+		return gliderData['m_lon'], gliderData['m_lat']
+	else:
+		print("##  m_lat and/or m_lon not present in files -> NO Dead Reckoning Correction")
+	return None
+
+
+def buildTrajectory(results):
+	"""
+	Builds the full trajectory from all processed segments.
+
+	Args:
+		results (list): (data, gliderData) tuples, one per segment.
+
+	Returns:
+		allData, allGliderData (pd.DataFrame)
+	"""
+	allData, allGliderData = concatSegments(results)
+	#
+	positions = deadReckonedPositions(allGliderData)
+	if positions is not None:
+		allData['lon_qc'], allData['lat_qc'] = positions
+	#
+	if 'depth' in allData.keys():
+		allData['profile_index'], allData['profile_direction'] = findProfiles(
+			allData['time'], allData['depth'], stall=20, shake=200)
+		allData['depth_qc'] = allData['depth']
+	#
+	return allData, allGliderData
+
+
+def deadReckoningTailStart(diveState, before, overlap=2):
+	"""
+	First row of the trajectory tail that is re-corrected for dead reckoning when appending new data:
+	the end (surfacing) of the dive 'overlap' dives before row 'before', so that every dive in the tail is complete.
+	"""
+	diveState = pd.Series(np.asarray(diveState, dtype=float)).ffill().to_numpy()
+	change = np.diff(diveState**2, n=1)
+	diveEnds = np.argwhere(np.logical_or(change == 5, change == 12))[:, 0] + 1
+	diveEnds = diveEnds[diveEnds <= before]
+	if len(diveEnds) < overlap:
+		return 0
+	return int(diveEnds[-overlap])
+
+
+def variableValues(values, var):
+	"""
+	Casts values to the type of a netCDF variable, replacing nan's by the fill value for integer variables.
+	"""
+	values = np.asarray(values)
+	if np.issubdtype(var.dtype, np.integer):
+		fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else -999
+		values = np.where(np.isnan(values.astype(float)), fill, values).astype(var.dtype)
+	return values
+
+
+def updateValidRange(var, values):
+	"""
+	Widens numeric valid_min/valid_max attributes to include newly appended values.
+	"""
+	values = np.asarray(values, dtype=float)
+	if not np.any(~np.isnan(values)):
+		return
+	for key, func in [('valid_min', np.fmin), ('valid_max', np.fmax)]:
+		if key in var.ncattrs() and isinstance(var.getncattr(key), (float, np.floating)):
+			var.setncattr(key, func(var.getncattr(key), func.reduce(values[~np.isnan(values)])))
+
+
+def writeRows(root, frame, rows, skip=(), widenRange=False):
+	"""
+	Writes the rows of a frame into the time variables of a netCDF group; variables missing from the frame are filled.
+	The valid samples of gathered glider record variables (see data2attr.writeGathered) are appended instead.
+
+	Args:
+		root (netCDF4.Group): file or group to write to.
+		frame (pd.DataFrame): the rows to write.
+		rows (slice): rows of the time dimension to write to (may extend an unlimited dimension).
+		skip (list): variables not to write.
+		widenRange (bool): also widen the valid_min/valid_max attributes to the new values.
+	"""
+	for listName, listVar in root.variables.items():
+		if 'compress' not in listVar.ncattrs():
+			continue
+		names = [name for name, var in root.variables.items() if var.dimensions == (listName,) and name != listName]
+		values = {name: frame[name].to_numpy(dtype=float) for name in names if name in frame}
+		valid = np.flatnonzero(np.any([~np.isnan(v) for v in values.values()], axis=0)) if values else []
+		if len(valid) == 0:
+			continue
+		n = len(root.dimensions[listName])
+		listVar[n:n + len(valid)] = rows.start + valid
+		for name in names:
+			root[name][n:n + len(valid)] = values[name][valid] if name in values else np.nan
+	for name, var in root.variables.items():
+		if var.dimensions != ('time',) or name in skip:
+			continue
+		if name in frame:
+			values = frame[name].to_numpy()
+		else:
+			values = np.full(len(frame), np.nan)
+		var[rows] = variableValues(values, var)
+		if widenRange:
+			updateValidRange(var, values)
+
+
+def appendTrajectory(ncFilename, results, overlap=2):
+	"""
+	Appends new segments to an existing trajectory file along its unlimited time dimension.
+
+	Only rows after the end of the existing file are written.  The profile scan resumes at the head of
+	the last profile of the file (see gliderfuncs.resumeProfiles) and dead reckoned positions are
+	recomputed from 'overlap' dives before it, which is all the new data can affect.
+
+	Args:
+		ncFilename (str): trajectory file written by saveNetcdf (with an unlimited time dimension).
+		results (list): (data, gliderData) tuples of the new segments.
+		overlap (int): number of existing dives re-corrected together with the new data.
+
+	Returns:
+		True if the data was appended, False if the file must be rebuilt instead
+		(older data, new variables or types, or a file layout that can't be extended).
+	"""
+	newData, newGliderData = concatSegments(results)
+	if len(newData) != len(newGliderData) or newData.empty:
+		return False
+	#
+	with netCDF4.Dataset(ncFilename, 'a') as nc:
+		if 'glider_record' not in nc.groups or not nc.dimensions['time'].isunlimited():
+			return False
+		group = nc.groups['glider_record']
+		derived = ['profile_index', 'profile_direction']
+		if any(col not in nc.variables for col in newData.columns if col not in derived) or \
+				any(col not in group.variables for col in newGliderData.columns) or \
+				any((group[col].dtype.kind == 'f') != (newGliderData[col].dtype.kind == 'f') for col in newGliderData.columns) or \
+				any(group[col].dtype.kind == 'f' and group[col].dtype.itemsize < newGliderData[col].dtype.itemsize for col in newGliderData.columns):
+			return False
+		#
+		oldTime = np.ma.filled(nc['time'][:], np.nan)
+		nOld = len(oldTime)
+		if nOld == 0 or newData['time'].iloc[0] <= np.nanmax(oldTime):
+			return False
+		# the rows of the glider record are written (and its dead reckoning read) at the rows of the root
+		if 'time' not in group.variables or len(group['time']) != nOld:
+			return False
+		rows = slice(nOld, nOld + len(newData))
+		newData['index'] = newGliderData['index'] = np.arange(nOld, nOld + len(newData))
+		#
+		# New rows of the measured variables
+		writeRows(nc, newData, rows, skip=derived, widenRange=True)
+		writeRows(group, newGliderData, rows, widenRange=True)
+		#
+		# Re-derive the tail of the trajectory-scale variables
+		tailStart = nOld
+		if 'profile_index' in nc.variables and 'depth' in nc.variables:
+			# resume the profile scan at the head of the last profile of the file
+			newDepth = newData['depth'].to_numpy() if 'depth' in newData else np.full(len(newData), np.nan)
+			tailStart, state = resumeProfiles(nc['profile_index'][:nOld], nc['time'], nc['depth'], stall=20, shake=200)
+			profileIndex, profileDirection, state = findProfilesChunk(newData['time'], newDepth, state, final=True)
+			nc['profile_index'][tailStart:] = profileIndex
+			nc['profile_direction'][tailStart:] = profileDirection
+			updateValidRange(nc['profile_index'], profileIndex)
+			nc['depth_qc'][rows] = variableValues(newDepth, nc['depth_qc'])
+		drStart = deadReckoningTailStart(gliderRecordValues(group, 'x_dr_state'), tailStart, overlap) if 'x_dr_state' in group.variables else tailStart
+		gliderNames = [name for name in ['time', 'm_lon', 'm_lat', 'x_dr_state', 'm_gps_lon', 'm_gps_lat'] if name in group.variables]
+		tailGliderData = pd.concat([
+			pd.DataFrame({name: gliderRecordValues(group, name, slice(drStart, nOld)) for name in gliderNames}),
+			newGliderData[[name for name in gliderNames if name in newGliderData]]], ignore_index=True)
+		#
+		positions = deadReckonedPositions(tailGliderData)
+		if positions is not None and 'lon_qc' in nc.variables:
+			lon, lat = (np.asarray(values, dtype=float) for values in positions)
+			# Keep existing values up to the first dive the tail could be corrected for
+			valid = np.flatnonzero(~np.isnan(lon[:nOld - drStart]))
+			first = valid[0] if valid.size else nOld - drStart
+			nc['lon_qc'][drStart + first:] = variableValues(lon[first:], nc['lon_qc'])
+			nc['lat_qc'][drStart + first:] = variableValues(lat[first:], nc['lat_qc'])
+	return True
+
+
+def segmentLayout(filename):
+	"""
+	Rows, time range and column types of a stored segment result, without loading the wide data.
+	"""
+	layout = frameLayout(filename)
+	meta, frames = loadFrames(filename, names=['data'], columns=['time'])
+	time = frames['data']['time'].to_numpy()
+	return {
+		'filename': filename,
+		'rows': len(time),
+		'start': np.nanmin(time) if len(time) else np.inf,
+		'data': {col: dtype for col, dtype, rows in layout['data']},
+		'gliderData': {col: dtype for col, dtype, rows in layout['gliderData']},
+	}
+
+
+def unionDtypes(columnDtypes):
+	"""
+	Column types of the concatenation of several frames (as pd.concat would give them), in sorted column order.
+	"""
+	columns = sorted(set().union(*columnDtypes))
+	dtypes = {}
+	for col in columns:
+		found = [dtypes_[col] for dtypes_ in columnDtypes if col in dtypes_]
+		dtype = np.result_type(*found)
+		if len(found) < len(columnDtypes) and dtype.kind in 'biu':
+			dtype = np.dtype(float)
+		dtypes[col] = dtype
+	return dtypes
+
+
+def mergeSegments(layouts, dataColumns=None, gliderColumns=None, chunkRows=100000):
+	"""
+	Streams stored segment results as one time ordered record, without holding the whole mission in memory.
+
+	Segments are read in order of their first timestamp and merged with the rows still buffered from
+	earlier segments; rows before the start of the next segment are final and are emitted in chunks.
+	Duplicate timestamps are dropped (first occurrence kept) from both frames so they stay row-aligned.
+
+	Args:
+		layouts (list): segmentLayout of each segment, in file order.
+		dataColumns, gliderColumns (list): columns to read (default: all).
+		chunkRows (int): maximum number of rows per emitted chunk.
+
+	Yields:
+		data, gliderData (pd.DataFrame) chunks with an 'index' column (row number in file order, as in buildTrajectory).
+	"""
+	offsets = np.cumsum([0] + [layout['rows'] for layout in layouts])
+	order = sorted(range(len(layouts)), key=lambda i: layouts[i]['start'])
+	bufferData, bufferGlider = pd.DataFrame(), pd.DataFrame()
+	lastTime = -np.inf
+	for k, i in enumerate(order):
+		columns = None if dataColumns is None and gliderColumns is None else set(dataColumns or []) | set(gliderColumns or []) | {'time'}
+		meta, frames = loadFrames(layouts[i]['filename'], columns=columns)
+		data, gliderData = frames['data'], frames['gliderData']
+		data.insert(0, 'index', np.arange(offsets[i], offsets[i + 1]))
+		gliderData.insert(0, 'index', data['index'].to_numpy())
+		bufferData = pd.concat([bufferData, data], ignore_index=True, sort=True)
+		bufferGlider = pd.concat([bufferGlider, gliderData], ignore_index=True, sort=True)
+		#
+		nextStart = layouts[order[k + 1]]['start'] if k + 1 < len(order) else np.inf
+		time = bufferData['time'].to_numpy()
+		sortIndex = np.argsort(time, kind='stable')
+		ready = sortIndex[time[sortIndex] < nextStart]
+		readyTime = time[ready]
+		# drop duplicate timestamps (the buffer is sorted, later chunks only hold later times)
+		unique = np.ones(len(ready), dtype=bool)
+		unique[1:] = np.diff(readyTime) != 0
+		unique &= readyTime != lastTime
+		emit = ready[unique]
+		if len(emit):
+			lastTime = time[emit[-1]]
+		for start in range(0, len(emit), chunkRows):
+			rows = emit[start:start + chunkRows]
+			yield (ignoreBadLatLon(bufferData.iloc[rows].reset_index(drop=True)),
+				   ignoreBadLatLon(bufferGlider.iloc[rows].reset_index(drop=True)))
+		keep = sortIndex[time[sortIndex] >= nextStart]
+		bufferData = bufferData.iloc[keep].reset_index(drop=True)
+		bufferGlider = bufferGlider.iloc[keep].reset_index(drop=True)
+
+
+def streamTrajectory(resultFilenames, sourceInfo, chunkBytes=256 * 2**20):
+	"""
+	Builds the trajectory file from the stored segment results in bounded memory.
+
+	The trajectory-scale variables (dead reckoned positions, profile indices) are derived from a first
+	pass over the few columns they need.  The full record is then merged in time order and written to
+	the trajectory file and its glider_record group in chunks of about chunkBytes.  Finally the data
+	dependent attributes are recomputed from the written file.
+
+	Args:
+		resultFilenames (list): segment result files (see manifest.saveResult) in file order.
+		sourceInfo (dict): trajectory information, as for saveNetcdf.
+		chunkBytes (int): approximate size of the chunks held in memory.
+	"""
+	layouts = [segmentLayout(f) for f in resultFilenames]
+	layouts = [layout for layout in layouts if layout['rows'] > 0]
+	if not layouts:
+		return
+	dataDtypes = unionDtypes([layout['data'] for layout in layouts])
+	gliderDtypes = unionDtypes([layout['gliderData'] for layout in layouts])
+	chunkRows = max(1024, chunkBytes // (8 * (len(dataDtypes) + len(gliderDtypes) + 2)))
+	#
+	# Trajectory-scale variables from the few columns they depend on
+	drColumns = [col for col in ['time', 'm_lon', 'm_lat', 'x_dr_state', 'm_gps_lon', 'm_gps_lat'] if col in gliderDtypes]
+	narrowGlider, depth, profiles = [], [], []
+	state = None
+	for data, gliderData in mergeSegments(layouts, ['time', 'depth'], drColumns, chunkRows):
+		narrowGlider.append(gliderData)
+		if 'depth' in dataDtypes:
+			# profiles are found chunk by chunk, resuming at the last cast that may continue
+			data = data.reindex(columns=['time', 'depth'])
+			depth.append(data['depth'].to_numpy(dtype=float))
+			profileIndex, profileDirection, state = findProfilesChunk(data['time'], depth[-1], state, stall=20, shake=200)
+			profiles.append((profileIndex, profileDirection))
+	narrowGlider = pd.concat(narrowGlider, ignore_index=True)
+	derived = {}
+	positions = deadReckonedPositions(narrowGlider)
+	if positions is not None:
+		derived['lon_qc'], derived['lat_qc'] = (np.asarray(values, dtype=float) for values in positions)
+	if 'depth' in dataDtypes:
+		profiles.append(findProfilesChunk(np.empty(0), np.empty(0), state, final=True)[:2])
+		derived['profile_index'], derived['profile_direction'] = (np.concatenate(values) for values in zip(*profiles))
+		derived['depth_qc'] = np.concatenate(depth)
+	del narrowGlider, depth, profiles
+	#
+	# Same column layout as buildTrajectory
+	dataColumns = ['index'] + list(dataDtypes) + [col for col in derived if col not in dataDtypes]
+	gliderColumns = ['index'] + list(gliderDtypes)
+	# sensors that are double precision in any segment are double in every chunk (and in the file)
+	doubleColumns = [col for col, dtype in gliderDtypes.items() if dtype == np.float64]
+	dtypes = {**dataDtypes, **{col: np.dtype(float) for col in derived}, 'index': np.dtype(np.int64)}
+	#
+	row = 0
+	nc = None
+	try:
+		for data, gliderData in mergeSegments(layouts, chunkRows=chunkRows):
+			data = data.reindex(columns=dataColumns).astype({col: dtypes[col] for col in dataColumns})
+			gliderData = compactFrame(gliderData.reindex(columns=gliderColumns).astype({'index': np.int64}))
+			gliderData = gliderData.astype({col: np.float64 for col in doubleColumns if gliderData[col].dtype.kind == 'f'})
+			rows = slice(row, row + len(data))
+			for col, values in derived.items():
+				data[col] = values[rows]
+			if nc is None:
+				saveNetcdf(data, gliderData, sourceInfo)
+				nc = netCDF4.Dataset(sourceInfo['ncFilename'], 'a')
+			else:
+				writeRows(nc, data, rows)
+				writeRows(nc.groups['glider_record'], gliderData, rows)
+			row += len(data)
+	finally:
+		if nc is not None:
+			nc.close()
+	#
+	refreshDataAttributes(sourceInfo['ncFilename'], sourceInfo)
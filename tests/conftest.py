@@ -0,0 +1,66 @@
+import os
+import sys
+import glob
+import numpy as np
+import pytest
+
+# the modules of the toolbox are flat scripts, imported as bd2nc.py imports them
+scriptsDir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'scripts')
+exampleDir = os.path.join(os.path.dirname(scriptsDir), 'example')
+sys.path.insert(0, scriptsDir)
+
+
+@pytest.fixture(scope='session')
+def sensorCacheDir(tmp_path_factory):
+	"""
+	Lower case links to the sensor cache files of the example mission (needed by dbdreader, see run.sh).
+	"""
+	cacheDir = tmp_path_factory.mktemp('cache')
+	for filename in glob.glob(os.path.join(exampleDir, 'cache', '*')):
+		os.symlink(filename, os.path.join(str(cacheDir), os.path.basename(filename).lower()))
+	return str(cacheDir)
+
+
+@pytest.fixture(scope='session')
+def exampleScience(sensorCacheDir):
+	"""
+	Time and CTD sensors of the first three science records of the example mission that hold data.
+
+	Returns:
+		dict of {'time', 'temperature', 'conductivity', 'pressure'} arrays by file name.
+	"""
+	dbdreader = pytest.importorskip('dbdreader')
+	records = {}
+	for filename in sorted(glob.glob(os.path.join(exampleDir, 'delayed', 'raw', '*.EBD'))):
+		bd = dbdreader.DBD(filename, cacheDir=sensorCacheDir)
+		values = bd.get_list('sci_water_temp', 'sci_water_cond', 'sci_water_pressure', return_nans=True)
+		bd.close()
+		if len(values[0][0]) > 100:
+			records[os.path.basename(filename)] = {'time': values[0][0], 'temperature': values[0][1],
+												   'conductivity': values[1][1], 'pressure': values[2][1]}
+		if len(records) == 3:
+			break
+	return records
+
+
+@pytest.fixture(scope='session')
+def exampleDepth(sensorCacheDir):
+	"""
+	Time and depth of the whole example mission, from the CTD pressure as in bd2nc.processData.
+
+	Returns:
+		tuple of (time, depth) arrays, in time order.
+	"""
+	dbdreader = pytest.importorskip('dbdreader')
+	from gliderfuncs import p2depth
+	stamp, pressure = [], []
+	for filename in sorted(glob.glob(os.path.join(exampleDir, 'delayed', 'raw', '*.EBD'))):
+		bd = dbdreader.DBD(filename, cacheDir=sensorCacheDir)
+		values = bd.get('sci_water_pressure', return_nans=True)
+		bd.close()
+		stamp.append(values[0])
+		pressure.append(values[1])
+	stamp = np.concatenate(stamp)
+	# bar to dbar
+	depth = p2depth(np.concatenate(pressure) * 10, time=stamp, interpolate=True, tgap=5)
+	return stamp, depth
@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bd2nc import mergeRecords
+
+
+def flightRecord():
+	return pd.DataFrame({'time': [1.5e9, 1.5e9 + 2, 1.5e9 + 4], 'm_depth': [1.0, 2.0, 3.0]})
+
+
+def test_mergeRecords_interleaves_by_time():
+	science = pd.DataFrame({'time': [1.5e9 + 1, 1.5e9 + 4], 'sci_water_temp': np.array([10, 11], dtype=np.float32)})
+	merged = mergeRecords(flightRecord(), science)
+	np.testing.assert_array_equal(merged['time'] - 1.5e9, [0, 1, 2, 4, 4])
+	np.testing.assert_array_equal(merged['m_depth'], [1, np.nan, 2, 3, np.nan])
+	np.testing.assert_array_equal(merged['sci_water_temp'], [np.nan, 10, np.nan, np.nan, 11])
+
+
+@pytest.mark.parametrize('tolerance', [None, 1.0])
+@pytest.mark.parametrize('rows', [0, 2])
+def test_mergeRecords_keeps_columns_of_record_without_time(tolerance, rows):
+	science = pd.DataFrame({'sci_water_temp': np.arange(rows, dtype=np.float32)})
+	for merged in [mergeRecords(flightRecord(), science, tolerance), mergeRecords(science, flightRecord(), tolerance)]:
+		assert list(merged.columns) == ['m_depth', 'sci_water_temp', 'time']
+		np.testing.assert_array_equal(merged['m_depth'], [1, 2, 3])
+		assert merged['sci_water_temp'].isna().all()
@@ -0,0 +1,30 @@
+import numpy as np
+import xarray as xr
+import netCDF4
+
+from data2attr import writeGroup
+
+
+def writeFile(filename, rootRows, groupRows):
+	with netCDF4.Dataset(filename, 'w') as nc:
+		writeGroup(nc, xr.Dataset({'time': ('time', np.arange(rootRows, dtype=float))}), {}, ['time'])
+		writeGroup(nc.createGroup('glider_record'), xr.Dataset({'time': ('time', np.arange(groupRows, dtype=float))}), {}, ['time'])
+
+
+def test_glider_record_shares_time_of_same_length(tmp_path):
+	filename = str(tmp_path / 'shared.nc')
+	writeFile(filename, 3, 3)
+	with netCDF4.Dataset(filename) as nc:
+		assert 'time' not in nc.groups['glider_record'].dimensions
+		np.testing.assert_array_equal(nc.groups['glider_record']['time'][:], [0, 1, 2])
+
+
+def test_glider_record_of_other_length_has_own_time(tmp_path):
+	filename = str(tmp_path / 'own.nc')
+	writeFile(filename, 3, 5)
+	with netCDF4.Dataset(filename) as nc:
+		group = nc.groups['glider_record']
+		assert group.dimensions['time'].isunlimited()
+		assert not np.ma.is_masked(nc['time'][:])
+		np.testing.assert_array_equal(nc['time'][:], [0, 1, 2])
+		np.testing.assert_array_equal(group['time'][:], [0, 1, 2, 3, 4])
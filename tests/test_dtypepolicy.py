@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from dtypepolicy import compactFrame, floatColumn
+
+
+def test_compactFrame_narrows_sensors_only_where_exact():
+	frame = pd.DataFrame({
+		'time': [1.7e9 + 0.1, 1.7e9 + 0.2, np.nan],
+		'm_depth': np.array([1.5, 2.25, np.nan]),       # exact in single precision
+		'sci_bsipar_par': np.array([0.1, 1 / 3, np.nan]),  # an 8-byte sensor
+		'm_pitch': np.array([0.5, 1.0, 2.0], dtype=np.float32),
+		'index': np.arange(3),
+	})
+	compactFrame(frame)
+	assert frame['time'].dtype == np.float64
+	assert frame['m_depth'].dtype == np.float32
+	assert frame['sci_bsipar_par'].dtype == np.float64
+	np.testing.assert_array_equal(frame['sci_bsipar_par'], [0.1, 1 / 3, np.nan])
+	assert frame['m_pitch'].dtype == np.float32
+	assert frame['index'].dtype == np.int64
+
+
+def test_compactFrame_states():
+	frame = pd.DataFrame({'x_dr_state': [0.0, 1.0, np.nan, 3.0], 'm_leak': [0.0, 0.5, 1 / 3, np.nan]})
+	compactFrame(frame)
+	assert frame['x_dr_state'].dtype == np.int8
+	np.testing.assert_array_equal(floatColumn(frame, 'x_dr_state'), [0, 1, np.nan, 3])
+	# a "state" that isn't one keeps its values
+	assert frame['m_leak'].dtype == np.float64
+	np.testing.assert_array_equal(frame['m_leak'], [0.0, 0.5, 1 / 3, np.nan])
@@ -0,0 +1,222 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from gliderfuncs import findProfiles, findProfilesChunk, resumeProfiles, correctDeadReckoning
+
+OPTIONS = {'stall': 20, 'shake': 200}
+
+
+def chunkedProfiles(stamp, depth, splits):
+	"""
+	findProfilesChunk over the chunks between the split rows (the last call is final).
+	"""
+	bounds = [0] + list(splits) + [len(depth)]
+	state, profileIndex, profileDirection = None, [], []
+	for k, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+		index, direction, state = findProfilesChunk(stamp[start:end], depth[start:end], state,
+													final=k == len(bounds) - 2, **OPTIONS)
+		profileIndex.append(index)
+		profileDirection.append(direction)
+	return np.concatenate(profileIndex), np.concatenate(profileDirection)
+
+
+def randomSplits(n, nChunks, seed):
+	return np.sort(np.random.default_rng(seed).choice(np.arange(1, n), nChunks - 1, replace=False))
+
+
+@pytest.mark.parametrize('nChunks,seed', [(2, 0), (7, 1), (50, 2), (500, 3), (3000, 4)])
+def test_chunks_match_findProfiles(exampleDepth, nChunks, seed):
+	stamp, depth = exampleDepth
+	expected = findProfiles(stamp, depth, **OPTIONS)
+	assert np.nanmax(expected[0]) > 100
+	profileIndex, profileDirection = chunkedProfiles(stamp, depth, randomSplits(len(depth), nChunks, seed))
+	np.testing.assert_array_equal(profileIndex, expected[0])
+	np.testing.assert_array_equal(profileDirection, expected[1])
+
+
+def test_chunks_of_single_rows_match_findProfiles(exampleDepth):
+	stamp, depth = (values[:3000] for values in exampleDepth)
+	expected = findProfiles(stamp, depth, **OPTIONS)
+	profileIndex, profileDirection = chunkedProfiles(stamp, depth, range(1, len(depth)))
+	np.testing.assert_array_equal(profileIndex, expected[0])
+	np.testing.assert_array_equal(profileDirection, expected[1])
+
+
+def test_datetime_chunks_match_findProfiles(exampleDepth):
+	stamp, depth = exampleDepth
+	stamp = (stamp * 1e9).astype('datetime64[ns]')
+	expected = findProfiles(stamp, depth, **OPTIONS)
+	profileIndex, profileDirection = chunkedProfiles(stamp, depth, randomSplits(len(depth), 20, 5))
+	np.testing.assert_array_equal(profileIndex, expected[0])
+	np.testing.assert_array_equal(profileDirection, expected[1])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_resumed_appends_match_findProfiles(exampleDepth, seed):
+	"""
+	A record written once and then extended several times (as appendTrajectory does).
+	"""
+	stamp, depth = exampleDepth
+	expected = findProfiles(stamp, depth, **OPTIONS)
+	splits = randomSplits(len(depth), 6, 10 + seed)
+	profileIndex, profileDirection = findProfiles(stamp[:splits[0]], depth[:splits[0]], **OPTIONS)
+	for nOld, end in zip(splits, list(splits[1:]) + [len(depth)]):
+		start, state = resumeProfiles(profileIndex, stamp, depth, **OPTIONS)
+		index, direction, state = findProfilesChunk(stamp[nOld:end], depth[nOld:end], state, final=True)
+		profileIndex = np.concatenate([profileIndex[:start], index])
+		profileDirection = np.concatenate([profileDirection[:start], direction])
+		assert len(profileIndex) == end
+	np.testing.assert_array_equal(profileIndex, expected[0])
+	np.testing.assert_array_equal(profileDirection, expected[1])
+
+
+def correctDeadReckoningLoop(gliderLon, gliderLat, gliderTimestamp, diveState, gpsLon, gpsLat):
+	"""
+	correctDeadReckoning of the baseline (reference, without its debug print).
+	"""
+	#
+	# Fill NaN values with previous value
+	diveState = diveState.ffill()
+	#
+	# Find the start of each dive
+	diveStarts = np.argwhere(np.diff(diveState**2) != 0).flatten()
+	diveStarts = diveStarts[np.argwhere(np.diff(diveState[diveStarts]**2, n=2, axis=0) == 18).flatten()]
+	#
+	# Remove diveStarts with NaN values
+	for ki in range(len(diveStarts)):
+		while gliderLon[diveStarts[ki]] != gliderLon[diveStarts[ki]]:
+			diveStarts[ki] = diveStarts[ki] + 1
+	#
+	# Find the end of each dive (diveState 2 -> 3 or 2 -> 4)
+	diveEnds = np.argwhere(np.logical_or(np.diff(diveState**2, n=1) == 5, np.diff(diveState**2, n=1) == 12))[:,0]+1
+	#
+	# Remove diveEnds with NaN values
+	for ki in range(len(diveEnds)):
+		while (gliderLon[diveEnds[ki]] != gliderLon[diveEnds[ki]]) and (gpsLon[diveEnds[ki]] != gpsLon[diveEnds[ki]]):
+			diveEnds[ki] = diveEnds[ki] + 1
+	#
+	# Find the midpoint of each dive
+	diveMids = np.argwhere(np.diff(diveState**2, n=1) == 3)[:,0]
+	#
+	for ki in range(len(diveMids)):
+		while gliderLon[diveMids[ki]] != gliderLon[diveMids[ki]]:
+			diveMids[ki] = diveMids[ki] - 1
+	#
+	# Calculate the velocity for longitude and latitude
+	timeDiff = gliderTimestamp[diveMids].to_numpy() - gliderTimestamp[diveStarts].to_numpy()
+	vlonDD = (gliderLon[diveEnds].to_numpy() - gliderLon[diveMids].to_numpy()) / timeDiff
+	vlatDD = (gliderLat[diveEnds].to_numpy() - gliderLat[diveMids].to_numpy()) / timeDiff
+	#
+	# Calculate the corrected latitude and longitude
+	loncDD = np.array(())
+	latcDD = np.array(())
+	ap = np.array(())
+	#
+	for i in range(len(diveStarts)):
+		idtemp = np.arange(diveStarts[i], diveMids[i] + 1)
+		a = (diveStarts[i] + np.argwhere((~gliderLon[idtemp].isna()).to_numpy())).flatten()
+		#
+		# This index is used to introduce "nan's" for padding to match array size to the original array
+		ap = np.hstack((ap, a))
+		if(len(a)==0):
+			continue
+		ti = (gliderTimestamp[a] - gliderTimestamp[a[0]]).to_numpy()
+		loncDD = np.hstack((loncDD, (gliderLon[a].to_numpy() + ti * vlonDD[i])))
+		latcDD = np.hstack((latcDD, (gliderLat[a].to_numpy() + ti * vlatDD[i])))
+	#
+	# Initialize the output arrays and fill them with the corrected values
+	correctedLon = gliderLon * np.nan
+	correctedLat = gliderLat * np.nan
+	correctedLon.iloc[ap.astype(int)] = loncDD
+	correctedLat.iloc[ap.astype(int)] = latcDD
+	#
+	return correctedLon, correctedLat
+
+
+# x_dr_state blocks: at the surface (4), diving (1), surfacing (2) and its gps fix (3)
+SURFACE, DIVE, SURFACING, FIX = [4] * 6, [1] * 40, [2] * 4, [3] * 3
+NORMAL_DIVE = DIVE + SURFACING + FIX + SURFACE
+
+
+def gliderRecord(states, seed=0):
+	"""
+	Glider record of a x_dr_state sequence: dead reckoned positions with gaps and gps positions at the fixes.
+	"""
+	rng = np.random.default_rng(seed)
+	states = np.asarray(states, dtype=float)
+	n = len(states)
+	stamp = np.cumsum(rng.uniform(5, 15, n)) + 1.6e9
+	lon = 10 + np.cumsum(rng.normal(0, 1e-4, n))
+	lat = 40 + np.cumsum(rng.normal(0, 1e-4, n))
+	gaps = rng.random(n) < 0.3
+	lon[gaps] = np.nan
+	lat[gaps] = np.nan
+	fixed = np.flatnonzero((states[:-1] == 2) & (states[1:] != 2)) + 1
+	gpsLon, gpsLat = np.full(n, np.nan), np.full(n, np.nan)
+	gpsLon[fixed] = lon[fixed] = 10 + rng.normal(0, 1e-2, len(fixed))
+	gpsLat[fixed] = lat[fixed] = 40 + rng.normal(0, 1e-2, len(fixed))
+	# the state isn't reported on every row
+	states[rng.random(n) < 0.2] = np.nan
+	states[0] = 4
+	return [pd.Series(values) for values in (lon, lat, stamp, states, gpsLon, gpsLat)]
+
+
+def subRecord(record, rows):
+	return [values.iloc[rows].reset_index(drop=True) for values in record]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_normal_dives_match_baseline(seed):
+	record = gliderRecord(SURFACE + NORMAL_DIVE * 4, seed)
+	for corrected, expected in zip(correctDeadReckoning(*record), correctDeadReckoningLoop(*record)):
+		assert np.isfinite(corrected).sum() > 100
+		np.testing.assert_array_equal(corrected, expected)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_excursion_belongs_to_dive(seed):
+	"""
+	1 -> 4 -> 1 without a fix: the dive starts at the first departure (the baseline started at the last).
+	"""
+	excursion = [1] * 15 + [4] * 5 + [1] * 25 + SURFACING + FIX + SURFACE
+	states = SURFACE + NORMAL_DIVE + excursion + NORMAL_DIVE
+	record = gliderRecord(states, seed)
+	# the same record with the excursion under water
+	start = len(SURFACE + NORMAL_DIVE) + 15
+	underWater = record[:3] + [record[3].copy()] + record[4:]
+	underWater[3][start:start + 5] = 1
+	for corrected, expected in zip(correctDeadReckoning(*record), correctDeadReckoningLoop(*underWater)):
+		np.testing.assert_array_equal(corrected, expected)
+	# the baseline agrees outside the dive of the excursion (which starts at the last row at the surface)
+	outside = np.r_[0:len(SURFACE + NORMAL_DIVE) - 1, len(states) - len(NORMAL_DIVE):len(states)]
+	for corrected, expected in zip(correctDeadReckoning(*record), correctDeadReckoningLoop(*record)):
+		np.testing.assert_array_equal(corrected[outside], expected[outside])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_dive_without_fix_at_end_is_uncorrected(seed):
+	states = SURFACE + NORMAL_DIVE * 2 + DIVE + SURFACING
+	record = gliderRecord(states, seed)
+	complete = len(SURFACE + NORMAL_DIVE * 2)
+	corrected = correctDeadReckoning(*record)
+	for values, expected in zip(corrected, correctDeadReckoningLoop(*subRecord(record, np.arange(complete)))):
+		np.testing.assert_array_equal(values[:complete], expected)
+		assert values[complete:].isna().all()
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_dive_without_fix_is_uncorrected(seed):
+	"""
+	The glider dives again after surfacing without a fix: neither dive has both a start and a fix.
+	"""
+	states = SURFACE + NORMAL_DIVE + DIVE + SURFACING + NORMAL_DIVE + NORMAL_DIVE
+	record = gliderRecord(states, seed)
+	# the dives start at the last row at the surface
+	first = len(SURFACE + NORMAL_DIVE) - 1
+	last = len(states) - len(NORMAL_DIVE) - 1
+	kept = np.r_[0:first, last:len(states)]
+	corrected = correctDeadReckoning(*record)
+	for values, expected in zip(corrected, correctDeadReckoningLoop(*subRecord(record, kept))):
+		np.testing.assert_array_equal(values[kept], expected)
+		assert values[first:last].isna().all()
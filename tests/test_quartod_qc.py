@@ -0,0 +1,218 @@
+import warnings
+import numpy as np
+import pytest
+
+from quartod_qc import getQCoptions, rangeCheckTest, spikeTest, rateOfChangeTest, flatLineTest, quartodQCbatch
+
+
+#######################################################################
+# Per-element loops the vectorized tests replaced (reference)
+
+def rangeCheckLoop(var, QCflag, sensorMin=-2, sensorMax=1200, userMin=-2, userMax=1200):
+	for i, value in enumerate(var):
+		if np.isnan(value):
+			continue
+		if value < sensorMin or value > sensorMax:
+			QCflag[i] = 4
+		elif value < userMin or value > userMax:
+			QCflag[i] = 3
+	return QCflag
+
+
+def spikeLoop(var, QCflag, thrshldLow=4, thrshldHigh=8):
+	var = np.asarray(var)
+	nonNANindices = np.where(~np.isnan(var))[0]
+
+	for i in nonNANindices[1:-1]:
+		if np.isnan(var[i]):
+			continue
+		spkRef = (var[i - 1] + var[i + 1]) / 2
+		spike = np.abs(var[i] - spkRef)
+		if thrshldLow < spike <= thrshldHigh:
+			QCflag[i] = 3
+		elif spike > thrshldHigh:
+			QCflag[i] = 4
+	return QCflag
+
+
+def rateOfChangeLoop(var, time, QCflag, nDev=3, timDev=25, minWindowSize=3):
+	if not isinstance(time[0], np.datetime64):
+		time = np.array(time, dtype='datetime64[ns]')
+
+	recentData = []
+	for i in range(1, len(var)):
+		if np.isnan(var[i]) or np.isnan(var[i - 1]):
+			continue
+		
+		timeDiff = (time[i] - time[i - 1]).astype('timedelta64[s]').astype(float) / 3600
+		if timeDiff <= 0:
+			continue
+		
+		rateOfChange = np.abs(var[i] - var[i - 1]) / (timeDiff + 1e-8)
+		recentData = [(t, v) for t, v in recentData if (time[i] - t).astype('timedelta64[h]').astype(float) < timDev]
+		recentData.append((time[i - 1], var[i - 1]))
+
+		if len(recentData) < minWindowSize:
+			continue
+
+		values = [v for t, v in recentData]
+		ratesOfChange = np.diff(values) / np.diff([t.astype(float) for t, _ in recentData])  # Calculate rates of change
+		meanRate = np.mean(ratesOfChange)
+		sd = np.std(ratesOfChange, ddof=1)
+		threshold = meanRate + nDev * sd
+
+		if rateOfChange > threshold:
+			QCflag[i] = 3
+
+	return QCflag
+
+
+def flatLineLoop(var, QCflag, eps=1e-6, repCntFail=5, repCntSuspect=3):
+	repeatCount = 0
+
+	for i in range(1, len(var)):
+		if np.isnan(var[i]) or np.isnan(var[i - 1]):
+			repeatCount = 0
+			continue
+		if abs(var[i] - var[i - 1]) < eps:
+			repeatCount += 1
+		else:
+			repeatCount = 0
+
+		if not np.isclose(var[i], 0, atol=1e-8):
+			if repeatCount >= repCntFail - 1:
+				QCflag[i] = 4
+			elif repeatCount >= repCntSuspect - 1:
+				QCflag[i] = 3
+	return QCflag
+
+
+#######################################################################
+
+VARIABLES = ['temperature', 'conductivity', 'pressure']
+
+
+def initialFlags(var):
+	# as quartodQCchecks: pass, or missing for nan and zero values
+	QCflag = np.ones(np.shape(var), dtype=int)
+	QCflag[np.isnan(var) | np.isclose(var, 0, atol=1e-8)] = 9
+	return QCflag
+
+
+def randomSeries(seed, n=600):
+	"""
+	Random walk with missing values, zeros, runs of repeated values and spikes.
+	"""
+	rng = np.random.default_rng(seed)
+	var = np.cumsum(rng.normal(0, 0.5, n)) + rng.uniform(-5, 30)
+	for start in rng.integers(0, n - 10, 15):
+		var[start:start + rng.integers(2, 9)] = var[start]
+	spikes = rng.integers(0, n, 20)
+	var[spikes] += rng.choice([-1, 1], 20) * rng.uniform(0, 20, 20)
+	var[rng.integers(0, n, 10)] = 0
+	var[rng.random(n) < 0.1] = np.nan
+	var[:rng.integers(0, 3)] = np.nan
+	return var
+
+
+def compareTests(var, options):
+	for vectorized, loop, args in [
+			(rangeCheckTest, rangeCheckLoop, ('sensorMin', 'sensorMax', 'sensor_userMin', 'sensor_userMax')),
+			(spikeTest, spikeLoop, ('spike_thrshldLow', 'spike_thrshldHigh')),
+			(flatLineTest, flatLineLoop, ('eps', 'repCntFail', 'repCntSuspect'))]:
+		values = [options[key] for key in args]
+		expected = loop(var, initialFlags(var), *values)
+		np.testing.assert_array_equal(vectorized(var, initialFlags(var), *values), expected, err_msg=vectorized.__name__)
+
+
+@pytest.mark.parametrize('name', VARIABLES)
+def test_example_mission(exampleScience, name):
+	options = getQCoptions(name)
+	for record in exampleScience.values():
+		compareTests(record[name], options)
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('name', VARIABLES)
+def test_random_series(seed, name):
+	compareTests(randomSeries(seed), getQCoptions(name))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rows_with_own_thresholds(seed):
+	# runQCtests runs the tests on one row per variable, with the thresholds as columns
+	var = np.vstack([randomSeries(seed * len(VARIABLES) + k) for k in range(len(VARIABLES))])
+	options = [getQCoptions(name) for name in VARIABLES]
+	def option(key):
+		return np.array([o[key] for o in options])[:, np.newaxis]
+	QCflag = initialFlags(var)
+	rangeCheckTest(var, QCflag, option('sensorMin'), option('sensorMax'), option('sensor_userMin'), option('sensor_userMax'))
+	spikeTest(var, QCflag, option('spike_thrshldLow'), option('spike_thrshldHigh'))
+	flatLineTest(var, QCflag, option('eps'), option('repCntFail'), option('repCntSuspect'))
+	for k, o in enumerate(options):
+		expected = initialFlags(var[k])
+		rangeCheckLoop(var[k], expected, o['sensorMin'], o['sensorMax'], o['sensor_userMin'], o['sensor_userMax'])
+		spikeLoop(var[k], expected, o['spike_thrshldLow'], o['spike_thrshldHigh'])
+		flatLineLoop(var[k], expected, o['eps'], o['repCntFail'], o['repCntSuspect'])
+		np.testing.assert_array_equal(QCflag[k], expected)
+
+
+def secondsToDatetime(time):
+	return (np.asarray(time) * 1e9).astype('int64').astype('datetime64[ns]')
+
+
+def randomTimes(seed, n=600):
+	"""
+	Increasing times (s) with irregular steps, repeated and missing steps and gaps of a few hours.
+	"""
+	rng = np.random.default_rng(seed)
+	steps = rng.choice([0, 0.4, 1, 2, 2, 3, 60, 900], n, p=[0.03, 0.1, 0.2, 0.3, 0.2, 0.1, 0.05, 0.02])
+	steps[rng.integers(0, n, 3)] = rng.uniform(3600, 4 * 3600, 3)
+	return 1.7e9 + np.cumsum(steps)
+
+
+def compareRateOfChange(var, time, nDev, timDev, minWindowSize):
+	with warnings.catch_warnings():
+		# np.std of a single rate (ddof=1) warns in the reference loop
+		warnings.simplefilter('ignore', RuntimeWarning)
+		expected = rateOfChangeLoop(var, time, initialFlags(var), nDev, timDev, minWindowSize)
+	np.testing.assert_array_equal(rateOfChangeTest(var, time, initialFlags(var), nDev, timDev, minWindowSize), expected)
+	return expected
+
+
+@pytest.mark.parametrize('name', VARIABLES)
+def test_rate_of_change_example_mission(exampleScience, name):
+	options = getQCoptions(name)
+	flagged = 0
+	for record in exampleScience.values():
+		# as processData passes it (float seconds) and as real times, where the windows hold up to an
+		# hour of samples (the first 600 samples only: the reference loop is quadratic in the window)
+		compareRateOfChange(record[name], record['time'], options['nDev'], options['time_dev'], options['min_wind_size'])
+		flags = compareRateOfChange(record[name][:600], secondsToDatetime(record['time'][:600]), options['nDev'], options['time_dev'], options['min_wind_size'])
+		flagged += np.sum(flags == 3)
+	assert flagged > 0
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('timDev, minWindowSize', [(300 / 3600, 10), (1, 3), (2.5, 2), (25, 1)])
+def test_rate_of_change_random_series(seed, timDev, minWindowSize):
+	var = randomSeries(seed)
+	compareRateOfChange(var, secondsToDatetime(randomTimes(seed, len(var))), 3, timDev, minWindowSize)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_batch_matches_loops(seed):
+	time = secondsToDatetime(randomTimes(seed))
+	data = {name: randomSeries(seed * len(VARIABLES) + k) for k, name in enumerate(VARIABLES)}
+	flags = quartodQCbatch(data, time, VARIABLES, threads=2)
+	for name in VARIABLES:
+		o = getQCoptions(name)
+		var = data[name]
+		expected = initialFlags(var)
+		rangeCheckLoop(var, expected, o['sensorMin'], o['sensorMax'], o['sensor_userMin'], o['sensor_userMax'])
+		spikeLoop(var, expected, o['spike_thrshldLow'], o['spike_thrshldHigh'])
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', RuntimeWarning)
+			rateOfChangeLoop(var, time, expected, o['nDev'], o['time_dev'], o['min_wind_size'])
+		flatLineLoop(var, expected, o['eps'], o['repCntFail'], o['repCntSuspect'])
+		np.testing.assert_array_equal(flags[name + '_qc'], expected, err_msg=name)
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import netCDF4
+
+from trajectory import concatSegments, appendTrajectory
+
+
+def segment(time, offset=0.0):
+	data = pd.DataFrame({'time': time, 'depth': np.arange(len(time)) + offset})
+	gliderData = pd.DataFrame({'time': time, 'm_depth': np.arange(len(time)) + offset})
+	return data, gliderData
+
+
+def test_concatSegments_drops_duplicates_from_both_frames():
+	allData, allGliderData = concatSegments([segment([3.0, 4.0, 5.0], 10), segment([1.0, 2.0, 3.0])])
+	assert len(allData) == len(allGliderData) == 5
+	np.testing.assert_array_equal(allData['time'], [1, 2, 3, 4, 5])
+	np.testing.assert_array_equal(allGliderData['time'], allData['time'])
+	np.testing.assert_array_equal(allGliderData['index'], allData['index'])
+	np.testing.assert_array_equal(allGliderData.index, allData.index)
+	# first occurrence in file order kept
+	np.testing.assert_array_equal(allData['depth'], [0, 1, 10, 11, 12])
+	np.testing.assert_array_equal(allGliderData['m_depth'], [0, 1, 10, 11, 12])
+
+
+def trajectoryFile(filename, rootRows, groupRows):
+	with netCDF4.Dataset(filename, 'w') as nc:
+		nc.createDimension('time', None)
+		for name, dtype in [('index', 'i8'), ('time', 'f8'), ('depth', 'f8')]:
+			nc.createVariable(name, dtype, ('time',))
+		nc['index'][:] = np.arange(rootRows)
+		nc['time'][:] = np.arange(rootRows, dtype=float)
+		nc['depth'][:] = np.arange(rootRows, dtype=float)
+		group = nc.createGroup('glider_record')
+		if groupRows != rootRows:
+			group.createDimension('time', None)
+		for name, dtype in [('index', 'i8'), ('time', 'f8'), ('m_depth', 'f4')]:
+			group.createVariable(name, dtype, ('time',))
+		group['index'][:] = np.arange(groupRows)
+		group['time'][:] = np.arange(groupRows, dtype=float)
+		group['m_depth'][:] = np.arange(groupRows, dtype=float)
+
+
+def test_appendTrajectory_extends_aligned_file(tmp_path):
+	filename = str(tmp_path / 'trajectory.nc')
+	trajectoryFile(filename, 3, 3)
+	assert appendTrajectory(filename, [segment([10.0, 11.0])])
+	with netCDF4.Dataset(filename) as nc:
+		np.testing.assert_array_equal(nc['time'][:], [0, 1, 2, 10, 11])
+		np.testing.assert_array_equal(nc.groups['glider_record']['time'][:], [0, 1, 2, 10, 11])
+		np.testing.assert_array_equal(nc.groups['glider_record']['index'][:], [0, 1, 2, 3, 4])
+
+
+def test_appendTrajectory_rebuilds_misaligned_glider_record(tmp_path):
+	filename = str(tmp_path / 'trajectory.nc')
+	trajectoryFile(filename, 3, 5)
+	assert not appendTrajectory(filename, [segment([10.0, 11.0])])
+	with netCDF4.Dataset(filename) as nc:
+		assert len(nc['time']) == 3
+		assert len(nc.groups['glider_record']['time']) == 5